@@ -1,18 +1,36 @@
+import re
 import glob
+import functools
+import http.server
 from urllib.parse import urlparse
 from bs4 import BeautifulSoup
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 import libvirt
 import libvirt_qemu
+import libvirtaio
+import asyncio
 import sys, os, time
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED
 from tarfile import TarFile
+import tarfile
+import gzip
+import struct
 import argparse
 import subprocess
 import sqlite3
 import shutil
 import hivex
+import hashlib
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import fcntl
+from contextlib import contextmanager
 import json
 import base64
+import cProfile
+import pstats
 import requests
 from tqdm import tqdm
 
@@ -29,7 +47,161 @@ def handler(ctxt, err):
 
 libvirt.registerErrorHandler(handler, "context")
 
+metricsLock = threading.Lock()
+metrics = {"phases": [], "counters": {}}
 
+
+def recordPhase(name, seconds, ok=True, **labels):
+    """Add a timed phase to this run's metrics"""
+    with metricsLock:
+        metrics["phases"].append(
+            {"phase": name, "seconds": seconds, "ok": ok, "labels": labels}
+        )
+
+
+def countMetric(name, value=1):
+    """Add value to one of this run's counters (bytes moved, retries, ...)"""
+    with metricsLock:
+        metrics["counters"][name] = metrics["counters"].get(name, 0) + value
+
+
+@contextmanager
+def phase(name, **labels):
+    """Time the enclosed block as a phase of this run, marking it failed on an exception"""
+    start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        recordPhase(name, time.time() - start, ok, **labels)
+
+
+def timed(name):
+    """Decorator timing every call of a function as the phase name"""
+
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with phase(name):
+                return fn(*args, **kwargs)
+
+        return inner
+
+    return wrap
+
+
+def promLabels(labels):
+    """Format a Prometheus label set"""
+    return ",".join(
+        '%s="%s"'
+        % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in sorted(labels.items())
+    )
+
+
+def writeMetrics(metricsdir, command, start, ok):
+    """
+    1. Write this run's phases and counters as JSON to <command>-<time>.json.
+    2. Write the per-phase totals and counters to hisck-<command>.prom for the
+       node_exporter textfile collector, replacing it atomically.
+    3. Return the JSON path."""
+    os.makedirs(metricsdir, exist_ok=True)
+    end = time.time()
+    with metricsLock:
+        phases = list(metrics["phases"])
+        counters = dict(metrics["counters"])
+    run = {
+        "command": command,
+        "host": os.uname().nodename,
+        "start": start,
+        "seconds": end - start,
+        "ok": ok,
+        "phases": phases,
+        "counters": counters,
+    }
+    path = os.path.join(
+        metricsdir, "%s-%s.json" % (command, time.strftime("%Y%m%d-%H%M%S", time.localtime(start)))
+    )
+    with open(path, "w") as f:
+        json.dump(run, f, indent=1)
+
+    totals = {}
+    for p in phases:
+        key = promLabels({"command": command, "phase": p["phase"]} | p["labels"])
+        seconds, count, failed = totals.get(key, (0.0, 0, 0))
+        totals[key] = (seconds + p["seconds"], count + 1, failed + (not p["ok"]))
+    base = promLabels({"command": command})
+    lines = [
+        "# HELP hisck_run_seconds Wall time of the last run.",
+        "# TYPE hisck_run_seconds gauge",
+        "hisck_run_seconds{%s} %f" % (base, end - start),
+        "# HELP hisck_run_success Whether the last run finished without an exception.",
+        "# TYPE hisck_run_success gauge",
+        "hisck_run_success{%s} %d" % (base, ok),
+        "# HELP hisck_run_timestamp_seconds When the last run finished.",
+        "# TYPE hisck_run_timestamp_seconds gauge",
+        "hisck_run_timestamp_seconds{%s} %f" % (base, end),
+        "# HELP hisck_phase_seconds Total wall time of a phase in the last run.",
+        "# TYPE hisck_phase_seconds gauge",
+    ]
+    lines += ["hisck_phase_seconds{%s} %f" % (k, v[0]) for k, v in totals.items()]
+    lines += [
+        "# HELP hisck_phase_runs Times a phase ran in the last run.",
+        "# TYPE hisck_phase_runs gauge",
+    ]
+    lines += ["hisck_phase_runs{%s} %d" % (k, v[1]) for k, v in totals.items()]
+    lines += [
+        "# HELP hisck_phase_failures Times a phase raised in the last run.",
+        "# TYPE hisck_phase_failures gauge",
+    ]
+    lines += ["hisck_phase_failures{%s} %d" % (k, v[2]) for k, v in totals.items()]
+    for name, value in sorted(counters.items()):
+        lines += [
+            "# TYPE hisck_%s gauge" % name,
+            "hisck_%s{%s} %s" % (name, base, value),
+        ]
+    prom = os.path.join(metricsdir, "hisck-%s.prom" % command)
+    with open(prom + ".tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(prom + ".tmp", prom)
+    return path
+
+
+COPY_BLOCKSIZE = 1024 * 1024
+PROGRESS_INTERVAL = 64 * 1024 * 1024
+
+
+def copySparse(inf, of, bar, blocksize=COPY_BLOCKSIZE):
+    """
+    1. Read the input into one preallocated buffer with readinto.
+    2. If a whole block is zero, seek past it instead of writing it so the output stays sparse.
+    3. Update the progress bar in batches instead of once per block.
+    4. Truncate the output to the final size (covers a trailing hole) and return the bytes copied."""
+    buf = bytearray(blocksize)
+    mv = memoryview(buf)
+    zeros = bytes(blocksize)
+    copied = 0
+    pending = 0
+    while True:
+        n = inf.readinto(buf)
+        if not n:
+            break
+        if n == blocksize and buf == zeros:
+            of.seek(n, os.SEEK_CUR)
+        else:
+            of.write(mv[:n])
+        copied += n
+        pending += n
+        if pending >= PROGRESS_INTERVAL:
+            bar.update(pending)
+            pending = 0
+    bar.update(pending)
+    of.truncate(copied)
+    return copied
+
+
+@timed("extractOVA")
 def extractOVA(src, workpath):
     """
     1. Extract the file name from the path.
@@ -54,17 +226,13 @@ def extractOVA(src, workpath):
                             unit_divisor=1024,
                         ) as bar:
                             with myzip.open(ovaname, "r") as inf:
-                                while True:
-                                    chunk = inf.read(1024)
-                                    if not chunk:
-                                        break
-                                    bar.update(len(chunk))
-                                    of.write(chunk)
+                                copySparse(inf, of, bar)
     except:
         pass
     return ovaname
 
 
+@timed("extractVMDK")
 def extractVMDK(ova, workpath):
     """
     1. Opens the OVA file as a tar archive
@@ -94,29 +262,106 @@ def extractVMDK(ova, workpath):
                     unit_divisor=1024,
                 ) as bar:
                     with mytar.extractfile(vmdk) as inf:
-                        while True:
-                            chunk = inf.read(1024)
-                            if not chunk:
-                                break
-                            bar.update(len(chunk))
-                            of.write(chunk)
+                        copySparse(inf, of, bar)
     return vmdk
 
-def snapshot(domain,name,desc):
-    process = subprocess.run(
-        [
-            "/usr/bin/virsh",
-            "snapshot-create-as",
-            "--domain",
-            domain,
-            "--name",
-            name,
-            "--description",
-            desc,
-            "--disk-only"
-        ]
+POSTINSTALL_SNAPSHOT = "postinstall"
+
+
+def snapshot(domain, name, desc, memory=True):
+    """
+    1. Build the snapshot XML; a running domain with memory gets an external
+       memory file next to its disks so the snapshot holds the whole running state.
+    2. Otherwise take an external disk-only snapshot.
+    3. Create it through the libvirt API and return it."""
+    xml = (
+        "<domainsnapshot><name>"
+        + escape(name)
+        + "</name><description>"
+        + escape(desc)
+        + "</description>"
     )
+    flags = 0
+    if memory and domain.isActive():
+        mem = os.path.join(os.getcwd(), domain.name() + "-" + name + ".mem")
+        xml += "<memory snapshot='external' file='" + escape(mem, {"'": "&apos;"}) + "'/>"
+    else:
+        xml += "<memory snapshot='no'/>"
+        flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY
+    xml += "</domainsnapshot>"
+    start = time.time()
+    snap = domain.snapshotCreateXML(xml, flags)
+    print("Snapshot %s of %s created in %.1fs" % (name, domain.name(), time.time() - start))
+    return snap
+
+
+def listSnapshots(domain):
+    """Print the snapshots of domain with their creation time and state"""
+    for snap in domain.listAllSnapshots():
+        root = ET.fromstring(snap.getXMLDesc())
+        created = int(root.findtext("creationTime", "0"))
+        print(
+            "%-20s %s %-10s %s%s"
+            % (
+                snap.getName(),
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created)),
+                root.findtext("state", ""),
+                root.findtext("description", ""),
+                " (current)" if snap.isCurrent() else "",
+            )
+        )
+
+
+# libvirt releases that can revert to and delete external snapshots
+SNAPSHOT_REVERT_LIBVIRT = 9007000
+SNAPSHOT_DELETE_LIBVIRT = 9000000
+
+
+def requireLibvirt(domain, version, action):
+    """Fail clearly if the libvirt daemon of domain is older than version (major * 1000000 + minor * 1000 + micro)"""
+    have = domain.connect().getLibVersion()
+    if have < version:
+        raise RuntimeError(
+            "%s an external snapshot needs libvirt %d.%d.%d or newer, this host runs %d.%d.%d"
+            % (
+                action,
+                version // 1000000,
+                version // 1000 % 1000,
+                version % 1000,
+                have // 1000000,
+                have // 1000 % 1000,
+                have % 1000,
+            )
+        )
+
+
+def revertSnapshot(domain, name):
+    """Revert domain to the snapshot name (running again if it holds memory) and return the time taken"""
+    requireLibvirt(domain, SNAPSHOT_REVERT_LIBVIRT, "Reverting to")
+    start = time.time()
+    snap = domain.snapshotLookupByName(name)
+    domain.revertToSnapshot(snap)
+    elapsed = time.time() - start
+    print("Reverted %s to %s in %.1fs" % (domain.name(), name, elapsed))
+    return elapsed
+
+
+def deleteSnapshot(domain, name):
+    """Delete the snapshot name of domain"""
+    requireLibvirt(domain, SNAPSHOT_DELETE_LIBVIRT, "Deleting")
+    domain.snapshotLookupByName(name).delete(0)
+
+
+def resetInstance(domain, name=POSTINSTALL_SNAPSHOT):
+    """Revert an instance to its post-install snapshot and wait for the agent, reporting the reset time"""
+    start = time.time()
+    revertSnapshot(domain, name)
+    if domain.isActive():
+        waitForAgent(domain, "reset")
+    print("Reset %s in %.1fs" % (domain.name(), time.time() - start))
 
+
+@timed("createOverlay")
 def createBaseInstanceQCOW2(qcow2, iname):
     """
     1. We import the subprocess module, which lets us run commands in the terminal.
@@ -126,7 +371,7 @@ def createBaseInstanceQCOW2(qcow2, iname):
     5. We use the subprocess module to run the qemu-img command, and pass the arguments listed above.
     6. We return the name of the new image to the caller."""
     print("Creating base image: " + iname + ".qcow2")
-    process = subprocess.run(
+    subprocess.run(
         [
             "/usr/bin/qemu-img",
             "create",
@@ -142,81 +387,486 @@ def createBaseInstanceQCOW2(qcow2, iname):
     return iname + ".qcow2"
 
 
-def translateQCOW2(vmdk, tmpdir):
+CONVERT_PROFILES = {
+    "default": {},
+    "parallel": {"coroutines": 16, "outoforder": True},
+    "compressed": {"coroutines": 8, "compress": True},
+    "prealloc": {
+        "coroutines": 16,
+        "outoforder": True,
+        "cluster_size": "2M",
+        "preallocation": "metadata",
+    },
+}
+
+
+def convertCmd(source, qcow2, profile="default"):
+    """Build the qemu-img convert command line for a conversion profile"""
+    opts = CONVERT_PROFILES[profile]
+    cl = ["/usr/bin/qemu-img", "convert", "-p", "-f", "vmdk", "-O", "qcow2"]
+    if "coroutines" in opts:
+        cl += ["-m", str(opts["coroutines"])]
+    if opts.get("outoforder"):
+        cl.append("-W")
+    if opts.get("compress"):
+        cl.append("-c")
+    o = []
+    if "cluster_size" in opts:
+        o.append("cluster_size=" + opts["cluster_size"])
+    if "preallocation" in opts:
+        o.append("preallocation=" + opts["preallocation"])
+    if o:
+        cl += ["-o", ",".join(o)]
+    return cl + [source, qcow2]
+
+
+def runConvert(cl, desc):
+    """Run qemu-img convert -p and drive a progress bar from its own percentage output"""
+    with tqdm(desc=desc, total=100, unit="%") as bar:
+        p = subprocess.Popen(cl, stdout=subprocess.PIPE)
+        last = 0.0
+        buf = b""
+        while True:
+            data = os.read(p.stdout.fileno(), 256)
+            if not data:
+                break
+            buf += data
+            *done, buf = re.split(rb"[\r\n]", buf)
+            for m in re.finditer(rb"\((\d+\.\d+)/100%\)", b"".join(done)):
+                now = float(m.group(1))
+                bar.update(now - last)
+                last = now
+        if p.wait() != 0:
+            raise Exception("qemu-img convert failed: " + " ".join(cl))
+        bar.update(100 - last)
+
+
+def recordConvert(tmpdir, profile, source, qcow2, elapsed):
+    """Append the wall time and output size of a conversion to convert-stats.jsonl"""
+    entry = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "profile": profile,
+        "source": source,
+        "wall": elapsed,
+        "size": os.path.getsize(qcow2),
+    }
+    os.makedirs(tmpdir, exist_ok=True)
+    with open(os.path.join(tmpdir, "convert-stats.jsonl"), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    countMetric("convert_bytes_written", entry["size"])
+    return entry
+
+
+@timed("convert")
+def translateQCOW2(vmdk, tmpdir, source=None, sourcesize=None, profile="default"):
     """
     1. Define a function called translateQCOW2 which takes a string called vmdk as input
     2. Create a string called qcow2 by replacing the last 5 characters of vmdk with .qcow2
     3. If there is no file with the name qcow2 in the current directory:
-        1. Run the command "qemu-img convert -f vmdk -O qcow2 vmdk qcow2" in the terminal
+        1. Run "qemu-img convert" with the options of the conversion profile
+        2. source overrides the input (e.g. a json: spec pointing into the zip)
+        3. Record the wall time and output size of the profile
     4. Return the string qcow2"""
     qcow2 = vmdk[:-5] + ".qcow2"
-    totalsize = os.path.getsize(os.path.join(tmpdir, vmdk)) * 2.5
+    if source is None:
+        source = os.path.join(tmpdir, vmdk)
+        sourcesize = os.path.getsize(source)
     if not os.path.exists(qcow2):
-        with tqdm(
-            desc=qcow2,
-            total=totalsize,
-            unit="B",
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as bar:
-            p = subprocess.Popen(
-                [
-                    "/usr/bin/qemu-img",
-                    "convert",
-                    "-f",
-                    "vmdk",
-                    "-O",
-                    "qcow2",
-                    os.path.join(tmpdir, vmdk),
-                    qcow2,
-                ],
-            )
-            last = 0
-            while p.poll() is None:
-                try:
-                    now = os.path.getsize(qcow2)
-                except:
-                    now = 0
-                bar.update(now - last)
-                last = now
-                time.sleep(1)
-        bar.update(
-            (os.path.getsize(os.path.join(tmpdir, vmdk)) * 2.5) - os.path.getsize(qcow2)
+        start = time.time()
+        runConvert(convertCmd(source, qcow2, profile), qcow2)
+        elapsed = time.time() - start
+        printRate("convert " + qcow2, sourcesize, elapsed)
+        recordConvert(tmpdir, profile, vmdk, qcow2, elapsed)
+    return qcow2
+
+
+def benchConvert(vmdk, tmpdir, profiles=None):
+    """Convert vmdk with every profile, record each one and print them fastest first"""
+    os.makedirs(tmpdir, exist_ok=True)
+    results = []
+    for profile in profiles or CONVERT_PROFILES:
+        qcow2 = os.path.join(tmpdir, "bench-" + profile + ".qcow2")
+        start = time.time()
+        runConvert(convertCmd(vmdk, qcow2, profile), profile)
+        results.append(
+            recordConvert(tmpdir, profile, vmdk, qcow2, time.time() - start)
+        )
+        os.remove(qcow2)
+    for r in sorted(results, key=lambda r: r["wall"]):
+        print("%-12s %8.1fs %14d bytes" % (r["profile"], r["wall"], r["size"]))
+    return results
+
+
+def printRate(desc, nbytes, elapsed):
+    """Print the throughput of a stage in MB/s"""
+    rate = nbytes / elapsed / (1024 * 1024) if elapsed > 0 else 0
+    print(
+        "%s: %d bytes in %.1fs (%.1f MB/s)" % (desc, nbytes, elapsed, rate)
+    )
+
+
+def zipDataOffset(src, zi):
+    """Return the offset of the data of a zip member inside the zip file"""
+    with open(src, "rb") as f:
+        f.seek(zi.header_offset)
+        fh = struct.unpack("<4s2B4HL2L2H", f.read(30))
+    return zi.header_offset + 30 + fh[10] + fh[11]
+
+
+def locateVMDK(src):
+    """
+    1. Open the zip and find the OVA inside it.
+    2. If the OVA is stored uncompressed, walk the tar headers in place.
+    3. Return the absolute offset and size of the VMDK inside the zip file,
+       or None if the OVA is compressed and has to be streamed instead."""
+    with ZipFile(src) as myzip:
+        ovaname = myzip.namelist()[0]
+        if not ovaname.endswith(".ova"):
+            raise Exception("Couldn't find OVA")
+        zi = myzip.getinfo(ovaname)
+    if zi.compress_type != ZIP_STORED:
+        return None
+    with open(src, "rb") as f:
+        f.seek(zipDataOffset(src, zi))
+        with TarFile(fileobj=f) as mytar:
+            for ti in mytar:
+                if ti.name.endswith(".vmdk"):
+                    return (os.path.basename(ti.name), ti.offset_data, ti.size)
+    raise Exception("Couldn't find VMDK")
+
+
+def streamVMDK(src, workpath):
+    """
+    1. Open the OVA inside the zip as a stream.
+    2. Read the tar members out of the stream without writing the OVA to disk.
+    3. Write the first ".vmdk" member to the working directory, unless it or
+       its converted qcow2 is already there.
+    4. Return the name of the VMDK file."""
+    with ZipFile(src) as myzip:
+        ovaname = myzip.namelist()[0]
+        if not ovaname.endswith(".ova"):
+            raise Exception("Couldn't find OVA")
+        with myzip.open(ovaname, "r") as inf:
+            with tarfile.open(fileobj=inf, mode="r|") as mytar:
+                for ti in mytar:
+                    if not ti.name.endswith(".vmdk"):
+                        continue
+                    vmdk = os.path.basename(ti.name)
+                    path = os.path.join(workpath, vmdk)
+                    if os.path.exists(path) or os.path.exists(vmdk[:-5] + ".qcow2"):
+                        return vmdk
+                    start = time.time()
+                    with open(path, "wb") as of:
+                        with tqdm(
+                            desc=path,
+                            total=ti.size,
+                            unit="B",
+                            unit_scale=True,
+                            unit_divisor=1024,
+                        ) as bar:
+                            with mytar.extractfile(ti) as vf:
+                                copySparse(vf, of, bar)
+                    printRate("extract " + vmdk, ti.size, time.time() - start)
+                    return vmdk
+    raise Exception("Couldn't find VMDK")
+
+
+@timed("createStorage")
+def createStorage(inputfile, instancename, tmpdir, stream=False, profile="default"):
+    """
+    1. Without stream, extract the OVA, then the VMDK, then convert it.
+    2. With stream, convert the VMDK in place inside the zip when the OVA is
+       stored uncompressed, so nothing is written to the working directory.
+    3. Otherwise pull the VMDK straight out of the zip stream (no OVA on disk),
+       convert it and remove the VMDK afterwards."""
+    if not stream:
+        ovaname = extractOVA(inputfile, tmpdir)
+        vmdk = extractVMDK(ovaname, tmpdir)
+        return translateQCOW2(vmdk, tmpdir, profile=profile)
+    located = locateVMDK(inputfile)
+    if located is not None:
+        vmdk, offset, size = located
+        source = "json:" + json.dumps(
+            {
+                "driver": "vmdk",
+                "file": {
+                    "driver": "raw",
+                    "offset": offset,
+                    "size": size,
+                    "file": {
+                        "driver": "file",
+                        "filename": os.path.abspath(inputfile),
+                    },
+                },
+            }
+        )
+        return translateQCOW2(
+            vmdk, tmpdir, source=source, sourcesize=size, profile=profile
         )
+    vmdk = streamVMDK(inputfile, tmpdir)
+    qcow2 = vmdk[:-5] + ".qcow2"
+    if os.path.exists(qcow2):
+        return qcow2
+    qcow2 = translateQCOW2(vmdk, tmpdir, profile=profile)
+    os.remove(os.path.join(tmpdir, vmdk))
     return qcow2
 
 
-def createStorage(inputfile, instancename, tmpdir):
-    ovaname = extractOVA(inputfile, tmpdir)
-    vmdk = extractVMDK(ovaname, tmpdir)
-    return translateQCOW2(vmdk, tmpdir)
+def benchCopy(tmpdir, size):
+    """
+    1. Build a synthetic tar in tmpdir holding one member of size bytes,
+       half random data and half zero blocks.
+    2. Extract it with the old 1024 byte read loop and with copySparse.
+    3. Print the time, throughput and allocated size of each output."""
+    os.makedirs(tmpdir, exist_ok=True)
+    tarpath = os.path.join(tmpdir, "bench.tar")
+    member = os.path.join(tmpdir, "bench.bin")
+    rnd = os.urandom(COPY_BLOCKSIZE)
+    zeros = bytes(COPY_BLOCKSIZE)
+    with open(member, "wb") as f:
+        for i in range(size // COPY_BLOCKSIZE):
+            f.write(rnd if i % 2 == 0 else zeros)
+    with TarFile(tarpath, "w") as mytar:
+        mytar.add(member, "bench.bin")
+    os.remove(member)
 
+    def legacy(inf, of, bar):
+        while True:
+            chunk = inf.read(1024)
+            if not chunk:
+                break
+            bar.update(len(chunk))
+            of.write(chunk)
 
-def findInstanceName(instancename, conn):
-    """The code above does the following, explained in English:
-    1. We are going to create a new instance, and we need to check if the name of the instance is already in use.
-    2. We start with the instance name given to us from the user.
-    3. We then try to find an instance with that name. If we find it, then we append a dash and a number to the name and start over.
-    4. We continue to look for the instance name, and increment the number on the end until we find a name that doesn't exist.
-    5. When we find a name that doesn't exist, we return it."""
+    for name, engine in (("legacy", legacy), ("sparse", copySparse)):
+        out = os.path.join(tmpdir, "bench-" + name + ".bin")
+        with TarFile(tarpath) as mytar:
+            ti = mytar.getmember("bench.bin")
+            start = time.time()
+            with open(out, "wb") as of:
+                with tqdm(
+                    desc=name,
+                    total=ti.size,
+                    unit="B",
+                    unit_scale=True,
+                    unit_divisor=1024,
+                ) as bar:
+                    with mytar.extractfile(ti) as inf:
+                        engine(inf, of, bar)
+            printRate(name, ti.size, time.time() - start)
+        print("%s allocated: %d bytes" % (name, os.stat(out).st_blocks * 512))
+        os.remove(out)
+    os.remove(tarpath)
+
+
+def allocateInstanceNames(instancename, conn, count=1, reserved=()):
+    """
+    1. Get the names of every defined domain with one listAllDomains call.
+    2. Walk the suffixes -1, -2, ... and take the first count names neither in
+       use nor reserved (names another process is about to define).
+    3. Return the list of names."""
+    used = {dom.name() for dom in conn.listAllDomains()} | set(reserved)
+    names = []
     i = 1
-    iname = ""
-    while True:
-        try:
-            if i == 0:
-                iname = instancename
-            else:
-                iname = instancename + "-" + str(i)
-            i += 1
-            dom = conn.lookupByName(iname)
-        except:
-            dom = None
-        if dom == None:
-            break
-    return iname
+    while len(names) < count:
+        iname = instancename + "-" + str(i)
+        if iname not in used:
+            names.append(iname)
+        i += 1
+    return names
+
+
+def findInstanceName(instancename, conn):
+    """Return the first free instancename-N name"""
+    return allocateInstanceNames(instancename, conn)[0]
+
+
+DOMAIN_TEMPLATE = "win11.xml"
 
+templateCache = {}
 
-def defineXML(iname, qcow2list, iqcow2):
+ET.register_namespace("libosinfo", "http://libosinfo.org/xmlns/libvirt/domain/1.0")
+
+
+def compileTemplate(path):
+    """
+    1. Parse the domain XML template once with ElementTree.
+    2. Replace the name, memory, vcpu, qcow2 disk, cdrom and backing store with @@slot@@ markers,
+       and the qcow2 disk's driver, target and address elements with whole-element slots.
+    3. Give the UEFI variable store a per-domain nvram slot and drop fixed MAC
+       addresses, so clones neither share one VARS file nor one MAC.
+    4. Serialize it and split it into static text and slot names.
+    5. Return the parts and the template's own value for each slot."""
+    root = ET.parse(path).getroot()
+    defaults = {}
+
+    def slot(name, default=None):
+        defaults.setdefault(name, default)
+        return "@@" + name + "@@"
+
+    def hole(el, name):
+        tail = el.tail
+        el.tail = None
+        defaults.setdefault(name, ET.tostring(el, encoding="unicode"))
+        el.clear()
+        el.tag = "hisckslot"
+        el.text = name
+        el.tail = tail
+
+    root.find("name").text = slot("name", root.find("name").text)
+    for tag in ("memory", "currentMemory"):
+        el = root.find(tag)
+        el.text = slot("memory", el.text)
+    vcpu = root.find("vcpu")
+    vcpu.text = slot("vcpus", vcpu.text)
+    vcpu.tail = "@@iothreads@@" + (vcpu.tail or "")
+    defaults["iothreads"] = ""
+    for disk in root.iter("disk"):
+        source = disk.find("source")
+        if source.get("file", "").endswith(".qcow2"):
+            source.set("file", slot("disk"))
+            hole(disk.find("driver"), "driver")
+            hole(disk.find("backingStore"), "backing")
+            hole(disk.find("target"), "target")
+            hole(disk.find("address"), "address")
+        elif disk.get("device") == "cdrom":
+            source.set("file", slot("cdrom", source.get("file")))
+    nvram = root.find("os/nvram")
+    if nvram is not None:
+        nvram.text = slot("nvram", nvram.text)
+    for iface in root.iter("interface"):
+        for mac in iface.findall("mac"):
+            iface.remove(mac)
+    text = ET.tostring(root, encoding="unicode")
+    text = re.sub(r"<hisckslot>(\w+)</hisckslot>", r"@@\1@@", text)
+    return re.split(r"@@(\w+)@@", text), defaults
+
+
+IO_PROFILES = {
+    "default": {},
+    "throughput": {
+        "driver": {"cache": "none", "io": "io_uring", "discard": "unmap"},
+        "bus": "virtio",
+        "iothreads": 2,
+        "queues": 4,
+    },
+    "density": {
+        "driver": {"discard": "unmap", "detect_zeroes": "unmap"},
+    },
+}
+
+
+VIRTIO_BOOT_MARKER = ".virtio-boot"
+
+
+def virtioBootable(images):
+    """True if one of the images was checked to load viostor at boot (see createCustomizedImage)"""
+    return any(os.path.exists(img + VIRTIO_BOOT_MARKER) for img in images)
+
+
+def ioProfileXML(profile, defaults, virtioBoot=False):
+    """
+    1. Start from the template's own driver, target and address elements.
+    2. Add the cache/io/discard settings of the profile to the driver.
+    3. For a virtio profile, move the disk to virtio-blk with an iothread and
+       multiqueue, and drop the SATA drive address so libvirt assigns a PCI one.
+       Only when virtioBoot says the image boots from virtio-blk; otherwise
+       Windows would stop with INACCESSIBLE_BOOT_DEVICE, so the bus is kept.
+    4. Return the values of the driver, target, address and iothreads slots."""
+    opts = IO_PROFILES[profile]
+    values = {k: defaults[k] for k in ("driver", "target", "address", "iothreads")}
+    if not opts:
+        return values
+    driver = ET.fromstring(defaults["driver"])
+    for k, v in opts.get("driver", {}).items():
+        driver.set(k, v)
+    if opts.get("bus") == "virtio" and not virtioBoot:
+        print(
+            "viostor is not a boot-start driver in this image, keeping the boot disk on "
+            + ET.fromstring(defaults["target"]).get("bus")
+        )
+    elif opts.get("bus") == "virtio":
+        target = ET.fromstring(defaults["target"])
+        target.set("dev", "vda")
+        target.set("bus", "virtio")
+        values["target"] = ET.tostring(target, encoding="unicode")
+        values["address"] = ""
+        if opts.get("iothreads"):
+            driver.set("iothread", "1")
+            values["iothreads"] = (
+                "<iothreads>" + str(opts["iothreads"]) + "</iothreads>"
+            )
+        if opts.get("queues"):
+            driver.set("queues", str(opts["queues"]))
+    values["driver"] = ET.tostring(driver, encoding="unicode")
+    return values
+
+
+def loadTemplate(path=DOMAIN_TEMPLATE):
+    """Return the compiled template, compiling it again only when the file changed"""
+    mtime = os.stat(path).st_mtime
+    cached = templateCache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, compileTemplate(path))
+        templateCache[path] = cached
+    return cached[1]
+
+
+def backingChainXML(qcow2list):
+    """Render nested backingStore elements for each backing qcow2 file"""
+    xml = ""
+    for bs in qcow2list:
+        xml += (
+            "<backingStore type='file'><format type='qcow2'/><source file='"
+            + escape(os.path.join(os.getcwd(), bs), {"'": "&apos;"})
+            + "'/>"
+        )
+    return xml + "<backingStore/>" + "</backingStore>" * len(qcow2list)
+
+
+def renderDomainXML(
+    iname,
+    qcow2list,
+    iqcow2,
+    memory=None,
+    vcpus=None,
+    cdrom=None,
+    ioprofile="default",
+    template=DOMAIN_TEMPLATE,
+):
+    """Render a domain from the cached template (memory in KiB)"""
+    parts, defaults = loadTemplate(template)
+    virtioBoot = IO_PROFILES[ioprofile].get("bus") == "virtio" and virtioBootable(
+        [iqcow2] + list(qcow2list)
+    )
+    values = ioProfileXML(ioprofile, defaults, virtioBoot)
+    values |= {
+        "name": escape(iname),
+        "memory": str(memory or defaults["memory"]),
+        "vcpus": str(vcpus or defaults["vcpus"]),
+        "disk": escape(os.path.join(os.getcwd(), iqcow2), {'"': "&quot;"}),
+        "cdrom": escape(cdrom or defaults["cdrom"], {'"': "&quot;"}),
+        "backing": backingChainXML(qcow2list),
+    }
+    if "nvram" in defaults:
+        values["nvram"] = escape(
+            os.path.join(os.path.dirname(defaults["nvram"]), iname + "_VARS.fd")
+        )
+    out = parts[:]
+    out[1::2] = [values[n] for n in parts[1::2]]
+    return "".join(out)
+
+
+def defineXML(
+    iname, qcow2list, iqcow2, memory=None, vcpus=None, ioprofile="default"
+):
+    """Render the domain XML for iname on top of the backing chain in qcow2list"""
+    return renderDomainXML(
+        iname, qcow2list, iqcow2, memory, vcpus, ioprofile=ioprofile
+    )
+
+
+def defineXMLSoup(iname, qcow2list, iqcow2):
     """The code above does the following, explained in English:
     1. Open the XML file as a string.
     2. Use the beautiful soup module to parse the string into a document object.
@@ -250,15 +900,34 @@ def defineXML(iname, qcow2list, iqcow2):
     return str(domainxml)
 
 
+def defineVM(domainxml, conn):
+    """Define a domain object from the XML definition passed as a parameter"""
+    dom = conn.defineXML(str(domainxml))
+    if not dom:
+        raise SystemExit("Failed to define a domain from an XML definition")
+    return dom
+
+
+def benchXML(iterations):
+    """Compare the render latency of the cached template with the BeautifulSoup path"""
+    chain = ["template.qcow2", "base.qcow2"]
+    for name, render in (("soup", defineXMLSoup), ("template", defineXML)):
+        render("bench", chain, "bench.qcow2")
+        start = time.perf_counter()
+        for i in range(iterations):
+            render("bench-" + str(i), chain, "bench-" + str(i) + ".qcow2")
+        elapsed = time.perf_counter() - start
+        print("%-8s %10.1f us/render" % (name, elapsed / iterations * 1e6))
+
+
+@timed("bootVM")
 def bootVM(domainxml, conn):
     """The code above does the following, explained in English:
     1. Creates a connection to the virtualization software ( xen, qemu, etc. )
     2. Defines a domain object from the XML definition passed as a parameter
     3. Creates the domain
     4. Returns the domain object"""
-    dom = conn.defineXML(str(domainxml))
-    if not dom:
-        raise SystemExit("Failed to define a domain from an XML definition")
+    dom = defineVM(domainxml, conn)
 
     if dom.create() < 0:
         raise SystemExit("Can not boot guest domain")
@@ -267,6 +936,131 @@ def bootVM(domainxml, conn):
     return dom
 
 
+EVENT_REBOOTED = -1
+SHUTDOWN_TIMEOUT = 600
+REBOOT_TIMEOUT = 600
+
+eventLoop = None
+eventWaiters = {}
+
+
+def domainEvent(conn, dom, event, detail, opaque):
+    """libvirt lifecycle callback: wake everything waiting for this event on this domain"""
+    for fut in eventWaiters.pop((dom.UUIDString(), event), []):
+        if not fut.done():
+            fut.set_result(detail)
+
+
+def domainReboot(conn, dom, opaque):
+    """libvirt reboot callback, delivered as the EVENT_REBOOTED pseudo lifecycle event"""
+    domainEvent(conn, dom, EVENT_REBOOTED, 0, opaque)
+
+
+def startEventLoop():
+    """Run a new asyncio loop forever in a daemon thread, so the command keeps
+    the main thread (and Ctrl-C) while libvirt events are delivered"""
+    global eventLoop
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    eventLoop = loop
+    return loop
+
+
+async def openEventConnection(uri="qemu:///system"):
+    """
+    1. Register the asyncio event implementation with libvirt (before opening the connection).
+    2. Open the connection and subscribe to lifecycle and reboot events of every domain.
+    3. Return the connection."""
+    global eventLoop
+    eventLoop = asyncio.get_running_loop()
+    libvirtaio.virEventRegisterAsyncIOImpl(loop=eventLoop)
+    conn = libvirt.open(uri)
+    conn.domainEventRegisterAny(
+        None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, domainEvent, None
+    )
+    conn.domainEventRegisterAny(
+        None, libvirt.VIR_DOMAIN_EVENT_ID_REBOOT, domainReboot, None
+    )
+    return conn
+
+
+async def waitDomainEvent(dom, event, action=None, timeout=None):
+    """
+    1. Register interest in event for dom before anything can trigger it.
+    2. Run the blocking action (e.g. dom.shutdown) in a worker thread.
+    3. Wait for the event, raising TimeoutError after timeout seconds."""
+    fut = asyncio.get_running_loop().create_future()
+    key = (dom.UUIDString(), event)
+    eventWaiters.setdefault(key, []).append(fut)
+    try:
+        if action is not None:
+            await asyncio.to_thread(action)
+        return await asyncio.wait_for(fut, timeout)
+    finally:
+        waiters = eventWaiters.get(key, [])
+        if fut in waiters:
+            waiters.remove(fut)
+        if not waiters:
+            eventWaiters.pop(key, None)
+
+
+async def gatherLimited(coros, limit):
+    """Run coroutines concurrently, at most limit at a time, and return their results"""
+    sem = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with sem:
+            return await coro
+
+    return await asyncio.gather(*(run(c) for c in coros))
+
+
+def runOnLoop(coro):
+    """Run a coroutine on the event loop from another thread and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, eventLoop).result()
+
+
+async def rebootDomainAsync(dom, timeout=REBOOT_TIMEOUT):
+    """Reboot dom and return once libvirt reports the guest rebooted"""
+    await waitDomainEvent(dom, EVENT_REBOOTED, dom.reboot, timeout)
+
+
+async def shutdownDomainAsync(dom, timeout=SHUTDOWN_TIMEOUT):
+    """Shut dom down and return once libvirt reports it stopped"""
+    if not dom.isActive():
+        return
+    await waitDomainEvent(
+        dom, libvirt.VIR_DOMAIN_EVENT_STOPPED, dom.shutdown, timeout
+    )
+
+
+@timed("reboot")
+def rebootDomain(dom):
+    """Reboot dom, waiting for the reboot event when events are available"""
+    if eventLoop is None:
+        dom.reboot()
+        time.sleep(15)
+        return
+    runOnLoop(rebootDomainAsync(dom))
+
+
+@timed("shutdown")
+def shutdownDomain(dom):
+    """Shut dom down and wait until it is off"""
+    if eventLoop is None:
+        dom.shutdown()
+        while dom.isActive():
+            time.sleep(5)
+        return
+    runOnLoop(shutdownDomainAsync(dom))
+
+
+def shutdownDomains(conn, names, jobs=4):
+    """Shut down several domains concurrently"""
+    doms = [conn.lookupByName(n) for n in names]
+    runOnLoop(gatherLimited([shutdownDomainAsync(d) for d in doms], jobs))
+
+
 def runFdisk(img):
     """Run and return the output of the fdisk command."""
     cl = [
@@ -278,13 +1072,16 @@ def runFdisk(img):
     return process.stdout
 
 
-def connectNBD(dev, img):
+@timed("nbdConnect")
+def connectNBD(dev, img, readonly=False):
     """Run and return the output of connecting the dev to /dev/nbd0"""
     cl = [
         "/usr/bin/qemu-nbd",
         "--connect=/dev/nbd0",
         img,
     ]
+    if readonly:
+        cl[2:2] = ["--read-only", "--force-share"]
     process = subprocess.run(cl, capture_output=True, check=True)
     return process.stdout
 
@@ -325,23 +1122,185 @@ def umountWin(dev):
     return process.stdout
 
 
+# a customized template is its tag overlay, three layers and the base, so only
+# chains deeper than that get flattened by default
+CHAIN_MAX_DEPTH = 6
+FLATTEN_LOCK = threading.Lock()
+
+
+def imageInfo(img, chain=False):
+    """Return qemu-img info for img as JSON, a list covering the backing chain with chain"""
+    cl = ["/usr/bin/qemu-img", "info", "--output=json", "-U"]
+    if chain:
+        cl.append("--backing-chain")
+    process = subprocess.run(cl + [img], capture_output=True, check=True)
+    return json.loads(process.stdout)
+
+
 def getBackingFile(img):
-    """Run qemu-img info to find the backing file for the img (only designed to with one backing file)"""
-    cl = [
-        "/usr/bin/qemu-img",
-        "info",
-        img,
-    ]
+    """Return the backing file recorded in img, or None"""
+    return imageInfo(img).get("backing-filename")
+
+
+def backingChain(img):
+    """Return img followed by every file in its backing chain, nearest first"""
+    return [layer["filename"] for layer in imageInfo(img, chain=True)]
+
+
+def activeImage(conn, name):
+    """Return the qcow2 the domain name writes to, read from its XML since an external
+    snapshot leaves <name>.qcow2 behind as a frozen backing file; <name>.qcow2 if
+    there is no such domain"""
+    try:
+        root = ET.fromstring(conn.lookupByName(name).XMLDesc(0))
+    except libvirt.libvirtError:
+        return name + ".qcow2"
+    for disk in root.findall("devices/disk[@device='disk']"):
+        driver = disk.find("driver")
+        source = disk.find("source")
+        if driver is not None and driver.get("type") == "qcow2" and source is not None:
+            return source.get("file")
+    return name + ".qcow2"
+
+
+def allocatedBytes(qcow2):
+    """Return the guest bytes that hold data in the top layer of qcow2"""
+    cl = ["/usr/bin/qemu-img", "map", "--output=json", "-U", qcow2]
     process = subprocess.run(cl, capture_output=True, check=True)
-    for l in process.stdout.decode("utf-8").split("\n"):
-        if l.startswith("backing file:"):
-            return l[14:]
+    return sum(
+        r["length"] for r in json.loads(process.stdout) if r["depth"] == 0 and r["data"]
+    )
+
+
+def showChain(img):
+    """Print each layer of the backing chain with its file size and the data it allocates"""
+    layers = imageInfo(img, chain=True)
+    mib = 1024 * 1024
+    print("%-5s %-6s %10s %10s %10s  %s" % ("depth", "format", "virtual", "file", "data", "image"))
+    for depth, layer in enumerate(layers):
+        data = allocatedBytes(layer["filename"])
+        print(
+            "%-5d %-6s %9dM %9dM %10s  %s"
+            % (
+                depth,
+                layer["format"],
+                layer["virtual-size"] // mib,
+                layer.get("actual-size", 0) // mib,
+                "%dM" % (data // mib),
+                layer["filename"],
+            )
+        )
+    return layers
+
+
+def commitImage(img, base=None):
+    """Merge img into its backing file (or down to base). Other images backed by
+    the layers in between are invalidated by this."""
+    cl = ["/usr/bin/qemu-img", "commit", "-p"]
+    if base is not None:
+        cl += ["-b", base]
+    subprocess.run(cl + [img], check=True)
+
+
+def rebaseImage(img, base):
+    """Rebase img onto base, copying in whatever differs between the old and new backing"""
+    cl = ["/usr/bin/qemu-img", "rebase", "-p", "-f", "qcow2", "-F", "qcow2"]
+    subprocess.run(cl + ["-b", os.path.abspath(base), img], check=True)
+
+
+@timed("flatten")
+def flattenImage(img, out, compress=False):
+    """Write the whole backing chain of img into one standalone qcow2 at out, through a
+    temporary file of its own so concurrent flattens never write the same file"""
+    start = time.time()
+    cl = ["/usr/bin/qemu-img", "convert", "-p", "-O", "qcow2"]
+    if compress:
+        cl.append("-c")
+    tmp = "%s.%d-%d.tmp" % (out, os.getpid(), threading.get_ident())
+    try:
+        subprocess.run(cl + [img, tmp], check=True)
+        os.replace(tmp, out)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    printRate("Flattened " + img, os.path.getsize(out), time.time() - start)
+    return out
 
 
+def domainImages(conn):
+    """Return the absolute path of every image a defined domain uses, backing files included"""
+    images = set()
+    for dom in conn.listAllDomains():
+        for source in ET.fromstring(dom.XMLDesc(0)).iter("source"):
+            if source.get("file"):
+                images.add(os.path.abspath(source.get("file")))
+    return images
+
+
+def pruneFlats(conn, name, keep):
+    """Remove the flattened copies of name other than keep, with their index and
+    marker files, unless a defined domain still uses them"""
+    used = domainImages(conn)
+    for flat in glob.glob(glob.escape(name) + ".flat-*.qcow2"):
+        if flat == keep or os.path.abspath(flat) in used:
+            continue
+        print("Removing superseded " + flat)
+        for path in (flat, flat + ".delta.db", flat + ".db", flat + VIRTIO_BOOT_MARKER):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def templateImage(name, maxdepth=CHAIN_MAX_DEPTH, conn=None):
+    """
+    1. Return <name>.qcow2 if its backing chain is at most maxdepth images deep (0 disables).
+    2. Otherwise return a flattened copy named after a hash of the chain, flattening it
+       and copying its index on first use, so new instances sit on a two level chain.
+       Threads and processes flatten one at a time, so the first one does the work.
+    3. With conn, remove the flattened copies of older chains no domain uses any more."""
+    top = name + ".qcow2"
+    chain = backingChain(top)
+    if not maxdepth or len(chain) <= maxdepth:
+        return top
+    key = hashlib.sha256(
+        json.dumps([(p, os.stat(p).st_mtime_ns) for p in chain]).encode("utf-8")
+    ).hexdigest()[:16]
+    flat = "%s.flat-%s.qcow2" % (name, key)
+    with FLATTEN_LOCK, open(name + ".flat.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(flat):
+            print("%s has a %d deep backing chain, flattening to %s" % (top, len(chain), flat))
+            flattenImage(top, flat)
+            src = indexPath(top)
+            if src is not None:
+                shutil.copyfile(src, flat + src[len(top) :])
+            if virtioBootable(chain):
+                open(flat + VIRTIO_BOOT_MARKER, "w").close()
+            if conn is not None:
+                pruneFlats(conn, name, flat)
+    return flat
+
+
+def manageChain(action, img, base=None, out=None, compress=False):
+    """Run a backing chain action: info, commit, rebase (onto base) or flatten (to out)"""
+    match action:
+        case "info":
+            showChain(img)
+        case "commit":
+            commitImage(img, base)
+        case "rebase":
+            if base is None:
+                raise ValueError("rebase needs --base")
+            rebaseImage(img, base)
+        case "flatten":
+            flattenImage(img, out or img[: -len(".qcow2")] + ".flat.qcow2", compress)
+
+
+@timed("tskLoadDB")
 def createSQLite(dev, dbpath):
-    """Create a SQLLite database from the dev using tsk_loaddb"""
+    """Create a SQLLite database from the dev using tsk_loaddb, with MD5 hashes for hash lookups"""
     cl = [
         "/usr/bin/tsk_loaddb",
+        "-h",
         "-d",
         dbpath,
         "-k",
@@ -354,8 +1313,7 @@ def createSQLite(dev, dbpath):
 def getParts(sconn):
     """ "Get parts from tsk_vs_parts"""
     # select  obj_id,addr,start,length,desc,flags from tsk_vs_parts
-    cursor = sconn.cursor()
-    rows = cursor.execute(
+    rows = sconn.execute(
         "select  obj_id,addr,start,length,desc,flags from tsk_vs_parts order by start"
     )
     return rows.fetchall()
@@ -363,20 +1321,160 @@ def getParts(sconn):
 
 def getStartupPart(sconn):
     """Find the partition we need for mucking with startup"""
-    cursor = sconn.cursor()
-    rows = cursor.execute(
-        "select distinct c.obj_id from tsk_files a, tsk_objects b, tsk_vs_parts c  where b.par_obj_id=c.obj_id and a.fs_obj_id=b.obj_id and a.parent_path like '/ProgramData/Microsoft/Windows/Start Menu/Programs/Startup/' and a.dir_type=3"
+    rows = sconn.execute(
+        "select distinct c.obj_id from tsk_files a, tsk_objects b, tsk_vs_parts c  where b.par_obj_id=c.obj_id and a.fs_obj_id=b.obj_id and a.parent_path=? and a.dir_type=3",
+        ("/ProgramData/Microsoft/Windows/Start Menu/Programs/Startup/",),
     )
     return rows.fetchall()[0][0]
 
 
-def getPartNo(obj_id, parts):
-    """Get the dev number for the partion"""
-    index = 0
-    for p in parts:
-        if obj_id == p[0]:
-            return index
-        index += 1
+INDEX_MMAP = 1024 * 1024 * 1024
+
+INDEX_SCHEMA = {
+    "tsk": """
+        create index if not exists hisck_files_path on tsk_files(parent_path, name, size, mtime, md5);
+        create index if not exists hisck_files_name on tsk_files(name, parent_path);
+        create index if not exists hisck_files_md5 on tsk_files(md5, parent_path, name);
+        create index if not exists hisck_files_mtime on tsk_files(mtime);
+        create index if not exists hisck_files_crtime on tsk_files(crtime);
+        """,
+    "delta": """
+        create index if not exists hisck_delta_path on delta_files(parent_path, name, size, mtime, status);
+        create index if not exists hisck_delta_name on delta_files(name, parent_path);
+        create index if not exists hisck_delta_mtime on delta_files(mtime);
+        """,
+}
+
+INDEX_QUERIES = {
+    "tsk": {
+        "path": "select parent_path, name, size, mtime, md5 from tsk_files where parent_path=? and name=?",
+        "name": "select parent_path, name, size, mtime, md5 from tsk_files where name=?",
+        "hash": "select parent_path, name, size, mtime, md5 from tsk_files where md5=?",
+        "list": "select parent_path, name, size, mtime, md5 from tsk_files where parent_path=? and name not in ('.', '..') order by name",
+        "since": "select parent_path, name, size, mtime, md5 from tsk_files where mtime>=? order by mtime",
+    },
+    "delta": {
+        "path": "select parent_path, name, size, mtime, status from delta_files where parent_path=? and name=?",
+        "name": "select parent_path, name, size, mtime, status from delta_files where name=?",
+        "list": "select parent_path, name, size, mtime, status from delta_files where parent_path=? order by name",
+        "since": "select parent_path, name, size, mtime, status from delta_files where mtime>=? order by mtime",
+    },
+}
+
+
+def indexKind(sconn):
+    """Return "delta" for an overlay delta index and "tsk" for a full tsk_loaddb index"""
+    row = sconn.execute(
+        "select 1 from sqlite_master where type='table' and name='delta_files'"
+    ).fetchone()
+    return "delta" if row else "tsk"
+
+
+def openIndex(dbpath):
+    """
+    1. Open an index database with WAL and a large mmap window.
+    2. Create the covering indexes for path, name, hash and timestamp lookups
+       and gather their statistics once, when the database has none yet.
+    3. Return the connection."""
+    sconn = sqlite3.connect(dbpath, cached_statements=64)
+    sconn.execute("pragma journal_mode=wal")
+    sconn.execute("pragma mmap_size=%d" % INDEX_MMAP)
+    sconn.execute("pragma temp_store=memory")
+    if not sconn.execute(
+        "select 1 from sqlite_master where type='table' and name='sqlite_stat1'"
+    ).fetchone():
+        sconn.executescript(INDEX_SCHEMA[indexKind(sconn)])
+        sconn.execute("analyze")
+    return sconn
+
+
+def splitPath(path):
+    """Split a guest path into the parent_path and name TSK stores"""
+    path = path.replace("\\", "/")
+    if re.match(r"^[A-Za-z]:", path):
+        path = path[2:]
+    path = "/" + path.lstrip("/")
+    parent, name = path.rsplit("/", 1)
+    return parent + "/", name
+
+
+def queryIndex(sconn, query, value):
+    """Run one of the prepared lookups (path, name, hash, list, since) and return the rows"""
+    kind = indexKind(sconn)
+    if query not in INDEX_QUERIES[kind]:
+        raise ValueError("%s lookups need a full tsk_loaddb index (--tskscan)" % query)
+    sql = INDEX_QUERIES[kind][query]
+    if query == "path":
+        args = splitPath(value)
+    elif query == "list":
+        args = (splitPath(value.rstrip("/\\") + "/x")[0],)
+    elif query == "since":
+        args = (int(value),)
+    else:
+        args = (value,)
+    return sconn.execute(sql, args).fetchall()
+
+
+def diffIndexes(adb, bdb):
+    """
+    1. Attach the second full index to the first.
+    2. Return (status, parent_path, name, size) for files added, deleted or
+       modified (size, mtime or hash) between them, matching files on their
+       data source and file system as well as their path."""
+    sconn = openIndex(adb)
+    openIndex(bdb).close()
+    sconn.execute("attach database ? as other", (bdb,))
+    rows = sconn.execute(
+        "select 'added', b.parent_path, b.name, b.size from other.tsk_files b where not exists (select 1 from main.tsk_files a where a.parent_path=b.parent_path and a.name=b.name and a.fs_obj_id=b.fs_obj_id and a.data_src_obj_id=b.data_src_obj_id) "
+        "union all select 'deleted', a.parent_path, a.name, a.size from main.tsk_files a where not exists (select 1 from other.tsk_files b where a.parent_path=b.parent_path and a.name=b.name and a.fs_obj_id=b.fs_obj_id and a.data_src_obj_id=b.data_src_obj_id) "
+        "union all select 'modified', b.parent_path, b.name, b.size from main.tsk_files a join other.tsk_files b on a.parent_path=b.parent_path and a.name=b.name and a.fs_obj_id=b.fs_obj_id and a.data_src_obj_id=b.data_src_obj_id "
+        "where a.size is not b.size or a.mtime is not b.mtime or a.md5 is not b.md5"
+    ).fetchall()
+    sconn.close()
+    return rows
+
+
+def runQuery(query, dbpath, value, otherdb=None):
+    """Answer a query against an index database and print the rows with timing"""
+    if not dbpath or not os.path.exists(dbpath):
+        raise ValueError("query needs an existing index database (--db): %s" % dbpath)
+    start = time.time()
+    if query == "diff":
+        sconn = openIndex(dbpath)
+        if indexKind(sconn) == "delta":
+            rows = [(r[4], r[0], r[1], r[2]) for r in queryIndex(sconn, "since", 0)]
+            sconn.close()
+        else:
+            sconn.close()
+            if not otherdb or not os.path.exists(otherdb):
+                raise ValueError("diff of a full index needs --otherdb: %s" % otherdb)
+            rows = diffIndexes(dbpath, otherdb)
+        for r in rows:
+            print("%-8s %12s %s%s" % (r[0], r[3], r[1], r[2]))
+    else:
+        rows = queryIndex(openIndex(dbpath), query, value)
+        for r in rows:
+            print(
+                "%s%s %s %s %s"
+                % (
+                    r[0],
+                    r[1],
+                    r[2],
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(r[3] or 0)),
+                    r[4] or "",
+                )
+            )
+    print("%d rows in %.3fs" % (len(rows), time.time() - start))
+    return rows
+
+
+def getPartNo(obj_id, parts):
+    """Get the dev number for the partion"""
+    index = 0
+    for p in parts:
+        if obj_id == p[0]:
+            return index
+        index += 1
     return -1
 
 
@@ -388,38 +1486,675 @@ def getMountDev(sconn, dev):
     return dev + "p" + str(portno)
 
 
+SECTOR = 512
+WINDOWS_LAYOUT = {"windows", "programdata", "users"}
+
+
+def readAt(f, offset, size):
+    """Read size bytes at offset from an open image or block device"""
+    f.seek(offset)
+    return f.read(size)
+
+
+def listPartitions(f):
+    """
+    1. Read the MBR and, when it is a protective MBR, the GPT header and entries.
+    2. Return (number, byte offset, byte length) for each partition, numbered like
+       the kernel does (slot index + 1), so number maps to <dev>p<number>."""
+    mbr = readAt(f, 0, SECTOR)
+    if mbr[510:512] != b"\x55\xaa":
+        return []
+    slots = [mbr[446 + i * 16 : 462 + i * 16] for i in range(4)]
+    if any(p[4] == 0xEE for p in slots):
+        hdr = readAt(f, SECTOR, SECTOR)
+        if hdr[0:8] != b"EFI PART":
+            return []
+        lba, count, size = struct.unpack_from("<QII", hdr, 72)
+        table = readAt(f, lba * SECTOR, count * size)
+        parts = []
+        for i in range(count):
+            e = table[i * size : (i + 1) * size]
+            if e[0:16] == bytes(16):
+                continue
+            first, last = struct.unpack_from("<QQ", e, 32)
+            parts.append((i + 1, first * SECTOR, (last - first + 1) * SECTOR))
+        return parts
+    parts = []
+    for i, p in enumerate(slots):
+        start, length = struct.unpack_from("<II", p, 8)
+        if p[4] not in (0x00, 0x05, 0x0F, 0x85) and length:
+            parts.append((i + 1, start * SECTOR, length * SECTOR))
+    return parts
+
+
+def applyFixup(rec):
+    """Apply the NTFS update sequence array to an MFT or INDX record"""
+    rec = bytearray(rec)
+    usaofs, usacount = struct.unpack_from("<HH", rec, 4)
+    for i in range(1, usacount):
+        end = i * SECTOR
+        rec[end - 2 : end] = rec[usaofs + i * 2 : usaofs + i * 2 + 2]
+    return rec
+
+
+def ntfsRecordSize(v, cluster):
+    """Decode the clusters-per-record byte of an NTFS boot sector"""
+    if v >= 0x80:
+        return 1 << (256 - v)
+    return v * cluster
+
+
+def ntfsGeometry(f, offset):
+    """Return (cluster size, MFT lcn, record size, index record size) of the NTFS at offset, or None"""
+    boot = readAt(f, offset, SECTOR)
+    if boot[3:11] != b"NTFS    ":
+        return None
+    bps, spc = struct.unpack_from("<HB", boot, 11)
+    cluster = bps * spc
+    mftlcn = struct.unpack_from("<Q", boot, 48)[0]
+    return (
+        cluster,
+        mftlcn,
+        ntfsRecordSize(boot[64], cluster),
+        ntfsRecordSize(boot[68], cluster),
+    )
+
+
+def decodeRunlist(data):
+    """Decode an NTFS runlist into (lcn, clusters) pairs"""
+    runs = []
+    pos = 0
+    lcn = 0
+    while data[pos]:
+        lensz = data[pos] & 0x0F
+        offsz = data[pos] >> 4
+        pos += 1
+        length = int.from_bytes(data[pos : pos + lensz], "little")
+        pos += lensz
+        if offsz:
+            lcn += int.from_bytes(data[pos : pos + offsz], "little", signed=True)
+            runs.append((lcn, length))
+        pos += offsz
+    return runs
+
+
+def indexNames(buf, pos, end):
+    """Yield the file names of the $I30 index entries between pos and end"""
+    while pos + 16 <= end:
+        elen, klen, flags = struct.unpack_from("<HHH", buf, pos + 8)
+        if flags & 0x02 or elen == 0:
+            break
+        if klen >= 66:
+            nlen = buf[pos + 16 + 64]
+            yield bytes(buf[pos + 16 + 66 : pos + 16 + 66 + nlen * 2]).decode(
+                "utf-16-le", "replace"
+            )
+        pos += elen
+
+
+def ntfsRootNames(f, offset):
+    """
+    1. Read the NTFS boot sector at offset, return None if it is not NTFS.
+    2. Read MFT record 5 (the root directory) and walk its $I30 INDEX_ROOT
+       and INDEX_ALLOCATION records.
+    3. Return the set of lower case names in the root directory."""
+    geo = ntfsGeometry(f, offset)
+    if geo is None:
+        return None
+    cluster, mftlcn, recsize, idxsize = geo
+    rec = applyFixup(readAt(f, offset + mftlcn * cluster + 5 * recsize, recsize))
+    if rec[0:4] != b"FILE":
+        return set()
+    names = set()
+    pos = struct.unpack_from("<H", rec, 20)[0]
+    while pos + 8 <= len(rec):
+        atype, alen = struct.unpack_from("<II", rec, pos)
+        if atype == 0xFFFFFFFF or alen == 0:
+            break
+        if atype == 0x90:
+            value = pos + struct.unpack_from("<H", rec, pos + 20)[0]
+            node = value + 16
+            first, total = struct.unpack_from("<II", rec, node)
+            names.update(indexNames(rec, node + first, node + total))
+        elif atype == 0xA0 and rec[pos + 8]:
+            runs = decodeRunlist(rec[pos + struct.unpack_from("<H", rec, pos + 32)[0] :])
+            data = b"".join(
+                readAt(f, offset + lcn * cluster, length * cluster)
+                for lcn, length in runs
+            )
+            for i in range(0, len(data), idxsize):
+                if data[i : i + 4] != b"INDX":
+                    continue
+                indx = applyFixup(data[i : i + idxsize])
+                first, total = struct.unpack_from("<II", indx, 24)
+                names.update(indexNames(indx, 24 + first, 24 + total))
+        pos += alen
+    return {n.lower() for n in names}
+
+
+def windowsPartition(f):
+    """
+    1. Read the partition table.
+    2. Probe each partition for an NTFS boot sector and read its root directory.
+    3. Return (number, offset, length) of the partition holding the Windows layout,
+       falling back to the largest NTFS partition, or None if there is none."""
+    best = None
+    for part in listPartitions(f):
+        names = ntfsRootNames(f, part[1])
+        if names is None:
+            continue
+        if WINDOWS_LAYOUT <= names:
+            return part
+        if best is None or part[2] > best[2]:
+            best = part
+    return best
+
+
+def locateWindowsPartition(dev):
+    """Return the number of the Windows partition on dev, failing if there is no NTFS partition"""
+    start = time.time()
+    with open(dev, "rb") as f:
+        part = windowsPartition(f)
+    if part is None:
+        raise RuntimeError("No NTFS partition found on " + dev)
+    print("Located Windows partition %d in %.3fs" % (part[0], time.time() - start))
+    return part[0]
+
+
+def locateMountDev(dev):
+    """Return the dev to mount for the windows partition without a TSK scan"""
+    return dev + "p" + str(locateWindowsPartition(dev))
+
+
+FILETIME_EPOCH = 116444736000000000
+
+
+def overlayRanges(qcow2):
+    """Return the (offset, length) ranges of the guest disk that the top qcow2 layer allocates"""
+    cl = [
+        "/usr/bin/qemu-img",
+        "map",
+        "--output=json",
+        "-U",
+        qcow2,
+    ]
+    process = subprocess.run(cl, capture_output=True, check=True)
+    return [
+        (r["start"], r["length"])
+        for r in json.loads(process.stdout)
+        if r["depth"] == 0 and (r["data"] or r["zero"])
+    ]
+
+
+def filetime(v):
+    """Convert a Windows FILETIME to unix seconds"""
+    return max(0, (v - FILETIME_EPOCH) // 10000000)
+
+
+def parseMFTRecord(rec):
+    """
+    1. Read the flags, sequence number, $STANDARD_INFORMATION times,
+       the long $FILE_NAME (name and parent) and the unnamed $DATA size.
+    2. Collect every non-DOS name in names: hard links (common under WinSxS)
+       carry one $FILE_NAME per link.
+    3. Return them as a dict, or None if the record is not a FILE record."""
+    if rec[0:4] != b"FILE":
+        return None
+    rec = applyFixup(rec)
+    seq, _, _, flags = struct.unpack_from("<HHHH", rec, 16)
+    info = {
+        "seq": seq,
+        "inuse": flags & 1,
+        "dir": 1 if flags & 2 else 0,
+        "name": None,
+        "parent": None,
+        "names": [],
+        "size": 0,
+        "crtime": 0,
+        "mtime": 0,
+        "ctime": 0,
+        "atime": 0,
+    }
+    namespace = -1
+    pos = struct.unpack_from("<H", rec, 20)[0]
+    while pos + 8 <= len(rec):
+        atype, alen = struct.unpack_from("<II", rec, pos)
+        if atype == 0xFFFFFFFF or alen == 0:
+            break
+        resident = rec[pos + 8] == 0
+        named = rec[pos + 9] != 0
+        value = pos + struct.unpack_from("<H", rec, pos + 20)[0]
+        if atype == 0x10 and resident:
+            times = struct.unpack_from("<QQQQ", rec, value)
+            info["crtime"], info["mtime"], info["ctime"], info["atime"] = map(
+                filetime, times
+            )
+        elif atype == 0x30 and resident:
+            ns = rec[value + 65]
+            nlen = rec[value + 64]
+            name = bytes(rec[value + 66 : value + 66 + nlen * 2]).decode(
+                "utf-16-le", "replace"
+            )
+            if ns != 2:
+                info["names"].append(name)
+            # prefer the Win32 (1) or POSIX (0) name over the DOS 8.3 (2) one
+            rank = {1: 3, 3: 3, 0: 2, 2: 1}.get(ns, 0)
+            if rank > namespace:
+                namespace = rank
+                info["parent"] = (
+                    struct.unpack_from("<Q", rec, value)[0] & 0xFFFFFFFFFFFF
+                )
+                info["name"] = name
+        elif atype == 0x80 and not named:
+            if resident:
+                info["size"] = struct.unpack_from("<I", rec, pos + 16)[0]
+            else:
+                info["size"] = struct.unpack_from("<Q", rec, pos + 48)[0]
+        pos += alen
+    if not info["names"] and info["name"] is not None:
+        info["names"] = [info["name"]]
+    return info
+
+
+def mftExtents(f, offset):
+    """Return the geometry and the (byte offset, first record, record count) extents of the $MFT"""
+    cluster, mftlcn, recsize, idxsize = ntfsGeometry(f, offset)
+    rec = applyFixup(readAt(f, offset + mftlcn * cluster, recsize))
+    pos = struct.unpack_from("<H", rec, 20)[0]
+    extents = []
+    while pos + 8 <= len(rec):
+        atype, alen = struct.unpack_from("<II", rec, pos)
+        if atype == 0xFFFFFFFF or alen == 0:
+            break
+        if atype == 0x80 and rec[pos + 8] and rec[pos + 9] == 0:
+            runs = decodeRunlist(rec[pos + struct.unpack_from("<H", rec, pos + 32)[0] :])
+            first = 0
+            for lcn, length in runs:
+                count = length * cluster // recsize
+                extents.append((offset + lcn * cluster, first, count))
+                first += count
+            break
+        pos += alen
+    return recsize, extents
+
+
+def changedMFTRecords(extents, recsize, ranges):
+    """Return the numbers of the MFT records that lie in the changed ranges"""
+    records = set()
+    for start, first, count in extents:
+        end = start + count * recsize
+        for rstart, rlength in ranges:
+            lo = max(start, rstart)
+            hi = min(end, rstart + rlength)
+            if lo < hi:
+                records.update(
+                    range(
+                        first + (lo - start) // recsize,
+                        first + (hi - start + recsize - 1) // recsize,
+                    )
+                )
+    return records
+
+
+def readMFTRecord(f, extents, recsize, number):
+    """Read MFT record number from the $MFT extents"""
+    for start, first, count in extents:
+        if first <= number < first + count:
+            return readAt(f, start + (number - first) * recsize, recsize)
+    return None
+
+
+def openIndexChain(dbpath):
+    """Open an index database and the parent indexes that delta databases point back to"""
+    chain = []
+    while dbpath and os.path.exists(dbpath):
+        sconn = sqlite3.connect(dbpath)
+        chain.append(sconn)
+        try:
+            row = sconn.execute(
+                "select value from delta_info where name='parent'"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            break
+        dbpath = row[0] if row else None
+    return chain
+
+
+def lookupIndexed(chain, fsoffset, addr):
+    """
+    1. Walk the index chain from the newest delta down to the full TSK index.
+    2. Return (names, size, mtime) of the file as that layer recorded it, where
+       names holds every name of a hard linked file, or None if it does not
+       exist there (or was deleted)."""
+    for sconn in chain:
+        try:
+            row = sconn.execute(
+                "select name, size, mtime, status from delta_files where fs_offset=? and meta_addr=?",
+                (fsoffset, addr),
+            ).fetchone()
+            if row is not None:
+                return None if row[3] == "deleted" else ({row[0]}, row[1], row[2])
+        except sqlite3.OperationalError:
+            rows = sconn.execute(
+                "select a.name, a.size, a.mtime from tsk_files a, tsk_fs_info b where a.fs_obj_id=b.obj_id and b.img_offset=? and a.meta_addr=? and a.name not in ('.', '..') and a.name not like '%:%'",
+                (fsoffset, addr),
+            ).fetchall()
+            if not rows:
+                return None
+            return ({r[0] for r in rows}, rows[0][1], rows[0][2])
+    return None
+
+
+@timed("indexOverlay")
+def indexOverlay(dev, qcow2, dbpath, parentdb=None):
+    """
+    1. Ask qemu-img which ranges the overlay qcow2 allocates.
+    2. Find the Windows partition on dev and the MFT records inside those ranges.
+    3. Compare each record with the parent index chain and classify it as
+       added, modified or deleted, skipping records that did not change.
+    4. Write the changed files into a delta database at dbpath that points back
+       to parentdb, and return the rows.
+    Without parentdb every record would count as added and deletions would be
+    lost, so that is only allowed for an image without a backing file (a full index)."""
+    if parentdb is None and getBackingFile(qcow2):
+        raise RuntimeError(
+            "No index for the backing file of %s; rebuild the template or use --tskscan"
+            % qcow2
+        )
+    start = time.time()
+    ranges = overlayRanges(qcow2)
+    chain = openIndexChain(parentdb)
+    rows = []
+    with open(dev, "rb") as f:
+        part = windowsPartition(f)
+        if part is None:
+            raise RuntimeError("No NTFS partition found on %s (%s)" % (dev, qcow2))
+        number, fsoffset, length = part
+        recsize, extents = mftExtents(f, fsoffset)
+        paths = {5: ""}
+
+        def record(n):
+            raw = readMFTRecord(f, extents, recsize, n)
+            return None if raw is None else parseMFTRecord(raw)
+
+        def path(n):
+            if n in paths:
+                return paths[n]
+            info = record(n)
+            if info is None or info["parent"] is None or info["parent"] == n:
+                paths[n] = ""
+            else:
+                paths[n] = path(info["parent"]) + "/" + info["name"]
+            return paths[n]
+
+        for n in sorted(changedMFTRecords(extents, recsize, ranges)):
+            info = record(n)
+            if info is None or info["name"] is None or n < 24:
+                continue
+            before = lookupIndexed(chain, fsoffset, n)
+            if not info["inuse"]:
+                if before is None:
+                    continue
+                status = "deleted"
+            elif before is None or not before[0] & set(info["names"]):
+                status = "added"
+            elif before[1] != info["size"] or before[2] != info["mtime"]:
+                status = "modified"
+            else:
+                continue
+            rows.append(
+                (
+                    fsoffset,
+                    n,
+                    info["seq"],
+                    info["parent"],
+                    info["name"],
+                    path(info["parent"]) + "/",
+                    info["dir"],
+                    info["size"],
+                    info["crtime"],
+                    info["mtime"],
+                    info["atime"],
+                    info["ctime"],
+                    status,
+                )
+            )
+    for sconn in chain:
+        sconn.close()
+    if os.path.exists(dbpath):
+        os.remove(dbpath)
+    sconn = sqlite3.connect(dbpath)
+    sconn.executescript(
+        """
+        create table delta_info (name text primary key, value text);
+        create table delta_files (
+            fs_offset integer, meta_addr integer, seq integer, par_addr integer,
+            name text, parent_path text, dir integer, size integer,
+            crtime integer, mtime integer, atime integer, ctime integer,
+            status text, primary key (fs_offset, meta_addr)
+        );
+        """
+    )
+    sconn.executemany(
+        "insert into delta_info values (?, ?)",
+        [
+            ("parent", parentdb),
+            ("image", qcow2),
+            ("created", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ],
+    )
+    sconn.executemany(
+        "insert into delta_files values (?,?,?,?,?,?,?,?,?,?,?,?,?)", rows
+    )
+    sconn.commit()
+    sconn.close()
+    print("Indexed %d changed files in %.1fs" % (len(rows), time.time() - start))
+    return rows
+
+
+def ensureIndex(dev, img):
+    """
+    1. Return the index database of img if it has one.
+    2. Otherwise make sure its backing file is indexed first; an image without a
+       backing file gets a full index of every MFT record it allocates.
+    3. Index img against that, e.g. an instance frozen by an external snapshot."""
+    dbpath = indexPath(img)
+    if dbpath is not None:
+        return dbpath
+    backing = getBackingFile(img)
+    parentdb = ensureIndex(dev, backing) if backing else None
+    print("Indexing " + img)
+    connectNBD(dev, img, readonly=True)
+    try:
+        indexOverlay(dev, img, img + ".delta.db", parentdb)
+    finally:
+        disconnectNBD(dev)
+    return img + ".delta.db"
+
+
+def indexPath(img):
+    """Return the index database of an image, preferring a delta index"""
+    for dbpath in (img + ".delta.db", img + ".db"):
+        if os.path.exists(dbpath):
+            return dbpath
+    return None
+
+
+def showChanges(d, iqcow2):
+    """Index the changes in an instance overlay and print what changed"""
+    backing = getBackingFile(iqcow2)
+    parentdb = ensureIndex(d, backing) if backing else None
+    connectNBD(d, iqcow2, readonly=True)
+    try:
+        rows = indexOverlay(d, iqcow2, iqcow2 + ".delta.db", parentdb)
+    finally:
+        disconnectNBD(d)
+    for r in rows:
+        print(
+            "%-8s %12d %s %s"
+            % (r[12], r[7], time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(r[9])), r[5] + r[4])
+        )
+
+
+HIVE_ROOT = "/mnt/win"
+
+HIVES = {
+    "SOFTWARE": "Windows/System32/config/SOFTWARE",
+    "SYSTEM": "Windows/System32/config/SYSTEM",
+    "SAM": "Windows/System32/config/SAM",
+    "SECURITY": "Windows/System32/config/SECURITY",
+    "DEFAULT": "Windows/System32/config/DEFAULT",
+    "NTUSER": "Users/Default/NTUSER.DAT",
+}
+
+REG_TYPES = {
+    "sz": 1,
+    "expand_sz": 2,
+    "binary": 3,
+    "dword": 4,
+    "multi_sz": 7,
+    "qword": 11,
+}
+
+DEFAULT_REGISTRY_SPEC = {
+    "SOFTWARE": [
+        {
+            "key": "Microsoft\\Windows\\CurrentVersion\\Policies\\System",
+            "name": "EnableLUA",
+            "type": "dword",
+            "value": 0,
+        },
+        {
+            "key": "Microsoft\\Windows\\CurrentVersion\\RunOnce",
+            "name": "hisck",
+            "type": "expand_sz",
+            "value": "c:\\hisck\\startup.exe",
+        },
+    ],
+}
+
+
+def hivePath(hive, root=HIVE_ROOT):
+    """Return the file of a hive name; NTUSER:<user> is that user's NTUSER.DAT"""
+    if hive.upper().startswith("NTUSER:"):
+        return os.path.join(root, "Users", hive.split(":", 1)[1], "NTUSER.DAT")
+    return os.path.join(root, HIVES[hive.upper()])
+
+
+def encodeRegValue(t, value):
+    """Encode a spec value as the raw bytes hivex stores for its type"""
+    match t:
+        case "sz" | "expand_sz":
+            return (value + "\0").encode("utf-16-le")
+        case "multi_sz":
+            return ("\0".join(value) + "\0\0").encode("utf-16-le")
+        case "dword":
+            return struct.pack("<I", value)
+        case "qword":
+            return struct.pack("<Q", value)
+        case "binary":
+            return bytes.fromhex(value)
+    raise Exception("Unknown registry type: " + t)
+
+
+VIRTIO_BOOT_DRIVER = "viostor"
+
+
+def bootDriverInstalled(service, root=HIVE_ROOT):
+    """True if the SYSTEM hive under root has service as a boot-start (Start=0) driver
+    in its current control set"""
+    h = hivex.Hivex(hivePath("SYSTEM", root))
+    select = h.node_get_child(h.root(), "Select")
+    if select is None:
+        return False
+    node = h.root()
+    current = h.value_dword(h.node_get_value(select, "Current"))
+    for part in ("ControlSet%03d" % current, "Services", service):
+        node = h.node_get_child(node, part)
+        if node is None:
+            return False
+    try:
+        return h.value_dword(h.node_get_value(node, "Start")) == 0
+    except RuntimeError:
+        return False
+
+
+def resolveKey(h, cache, path):
+    """
+    1. Start from the longest already resolved prefix of path.
+    2. Walk the rest with node_get_child, creating missing keys with node_add_child.
+    3. Cache every resolved prefix and return the node."""
+    parts = [p for p in path.split("\\") if p]
+    i = len(parts)
+    while i > 0 and "\\".join(parts[:i]).lower() not in cache:
+        i -= 1
+    node = cache["\\".join(parts[:i]).lower()] if i else h.root()
+    for j in range(i, len(parts)):
+        child = h.node_get_child(node, parts[j])
+        if child is None:
+            child = h.node_add_child(node, parts[j])
+        node = child
+        cache["\\".join(parts[: j + 1]).lower()] = node
+    return node
+
+
+def loadRegistrySpec(path=None):
+    """Return the default registry spec plus the edits from a JSON spec file"""
+    spec = {hive: list(edits) for hive, edits in DEFAULT_REGISTRY_SPEC.items()}
+    if path:
+        with open(path) as f:
+            for hive, edits in json.load(f).items():
+                spec.setdefault(hive, []).extend(edits)
+    return spec
+
+
+@timed("registryEdits")
+def applyRegistrySpec(spec, root=HIVE_ROOT):
+    """
+    1. Open each hive in the spec once.
+    2. Apply every edit: set a value, or with "delete" remove it, creating missing keys.
+    3. Commit each hive once and print how long it took."""
+    for hive, edits in spec.items():
+        start = time.time()
+        h = hivex.Hivex(hivePath(hive, root), write=True)
+        cache = {}
+        for edit in edits:
+            node = resolveKey(h, cache, edit["key"])
+            if edit.get("delete"):
+                values = [
+                    {
+                        "key": h.value_key(v),
+                        "t": h.value_type(v)[0],
+                        "value": h.value_value(v)[1],
+                    }
+                    for v in h.node_values(node)
+                    if h.value_key(v).lower() != edit["name"].lower()
+                ]
+                h.node_set_values(node, values)
+            else:
+                h.node_set_value(
+                    node,
+                    {
+                        "key": edit["name"],
+                        "t": REG_TYPES[edit["type"]],
+                        "value": encodeRegValue(edit["type"], edit["value"]),
+                    },
+                )
+        h.commit(None)
+        print("%s: %d edits in %.2fs" % (hive, len(edits), time.time() - start))
+
+
 def disableUAC():
     """Edit registry hive to disable UAC"""
-    h = hivex.Hivex("/mnt/win/Windows/System32/config/SOFTWARE", write=True)
-    key = h.root()
-    key = h.node_get_child(key, "Microsoft")
-    key = h.node_get_child(key, "Windows")
-    key = h.node_get_child(key, "CurrentVersion")
-    key = h.node_get_child(key, "Policies")
-    key = h.node_get_child(key, "System")
-    val = h.node_get_value(key, "EnableLUA")
-    value1 = {"key": "EnableLUA", "t": 4, "value": b"\x00\x00\x00\x00"}
-    h.node_set_value(key, value1)
-    h.commit(None)
+    applyRegistrySpec({"SOFTWARE": DEFAULT_REGISTRY_SPEC["SOFTWARE"][:1]})
 
 
 def setRunOnce():
-    """Edit registry hive to disable UAC"""
-    h = hivex.Hivex("/mnt/win/Windows/System32/config/SOFTWARE", write=True)
-    key = h.root()
-    key = h.node_get_child(key, "Microsoft")
-    key = h.node_get_child(key, "Windows")
-    key = h.node_get_child(key, "CurrentVersion")
-    key = h.node_get_child(key, "RunOnce")
-    value1 = {
-        "key": "hisck",
-        "t": 2,
-        "value": "c:\\hisck\\startup.exe".encode("utf-16-le"),
-    }
-    h.node_set_value(key, value1)
-    h.commit(None)
+    """Edit registry hive to run startup.exe once"""
+    applyRegistrySpec({"SOFTWARE": DEFAULT_REGISTRY_SPEC["SOFTWARE"][1:]})
 
 
+@timed("copyFiles")
 def copyFiles():
     """Copy startup.exe to the startup folder"""
     # shutil.copy(
@@ -431,12 +2166,12 @@ def copyFiles():
         os.getcwd() + "/startup/startup.exe",
         "/mnt/win/hisck",
     )
-    setRunOnce()
 
 
 def qemuAgentCommand(
     domain, cmd, timeout=10, flag=libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT
 ):
+    start = time.time()
     try:
         rawresult = libvirt_qemu.qemuAgentCommand(domain, cmd, timeout, flag)
         jsonresult = json.loads(rawresult)
@@ -444,244 +2179,1584 @@ def qemuAgentCommand(
     except Exception as e:
         #print(e)
         data = None
+        countMetric("agent_command_failures")
+    countMetric("agent_commands")
+    countMetric("agent_command_seconds", time.time() - start)
     return data
 
 
-def copyFileGA(domain, fromPath, toPath):
-    """Copy a file from the host to the guest"""
-    status = {"execute": "guest-file-open", "arguments": {"path": toPath, "mode": "w"}}
-    result = qemuAgentCommand(domain, json.dumps(status))
-    if result is None:
-        print("Error opening file")
-        return
-    handle = result["return"]
+GA_CHUNK_MIN = 64 * 1024
+GA_CHUNK_MAX = 16 * 1024 * 1024
+GA_WRITE_TIMEOUT = 60
+GA_WRITE_RETRIES = 5
+
+
+def sha256File(path):
+    """Return the hex SHA-256 of a host file"""
+    h = hashlib.sha256()
+    buf = bytearray(COPY_BLOCKSIZE)
+    mv = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(mv[:n])
+    return h.hexdigest()
+
+
+def guestSHA256(domain, path):
+    """Compute the SHA-256 of a file inside the guest with Get-FileHash"""
+    out = runPS1(
+        domain,
+        "(Get-FileHash -Algorithm SHA256 -LiteralPath '"
+        + path.replace("'", "''")
+        + "').Hash",
+    )
+    if not isinstance(out, str):
+        return None
+    return out.strip().lower()
+
+
+def guestFileSeek(domain, handle, offset, whence="set"):
+    """Seek an open guest file handle and return the new position"""
+    status = {
+        "execute": "guest-file-seek",
+        "arguments": {"handle": handle, "offset": offset, "whence": whence},
+    }
+    result = qemuAgentCommand(domain, json.dumps(status), GA_WRITE_TIMEOUT, 0)
+    if result is None or "return" not in result:
+        return None
+    return result["return"]["position"]
+
+
+def guestFileWrite(domain, handle, data):
+    """Write data to an open guest file handle and return the confirmed byte count"""
+    status = {
+        "execute": "guest-file-write",
+        "arguments": {
+            "handle": handle,
+            "buf-b64": base64.b64encode(data).decode("utf-8"),
+        },
+    }
+    result = qemuAgentCommand(domain, json.dumps(status), GA_WRITE_TIMEOUT, 0)
+    if result is None or "return" not in result:
+        return None
+    return result["return"]["count"]
+
+
+@timed("copyFileGA")
+def copyFileGA(domain, fromPath, toPath, resume=False, verify=True):
+    """
+    1. Open the guest file (with resume, reopen it and continue from its current size).
+    2. Send chunks with a blocking guest-file-write and check the count the agent confirms.
+    3. Grow the chunk size while writes succeed, halve it and rewind to the last
+       confirmed offset when a write fails or is short; a size that failed once
+       caps the growth from then on, so it is not retried every other write.
+    4. Report the throughput and, with verify, compare the guest SHA-256 with the host one.
+    5. Return the SHA-256 of the file, or None on failure."""
+    handle = None
+    offset = 0
+    if resume:
+        status = {
+            "execute": "guest-file-open",
+            "arguments": {"path": toPath, "mode": "rb+"},
+        }
+        result = qemuAgentCommand(domain, json.dumps(status), GA_WRITE_TIMEOUT, 0)
+        if result is not None and "return" in result:
+            handle = result["return"]
+            offset = guestFileSeek(domain, handle, 0, "end") or 0
+    if handle is None:
+        status = {
+            "execute": "guest-file-open",
+            "arguments": {"path": toPath, "mode": "wb"},
+        }
+        result = qemuAgentCommand(domain, json.dumps(status), GA_WRITE_TIMEOUT, 0)
+        if result is None or "return" not in result:
+            print("Error opening file")
+            return None
+        handle = result["return"]
 
     totalsize = os.path.getsize(fromPath)
+    if offset > totalsize:
+        offset = 0
+        guestFileSeek(domain, handle, 0)
+    chunk = GA_CHUNK_MIN
+    limit = GA_CHUNK_MAX
+    failures = 0
+    start = time.time()
+    sent = 0
     with tqdm(
         desc=os.path.basename(fromPath),
         total=totalsize,
+        initial=offset,
         unit="B",
         unit_scale=True,
         unit_divisor=1024,
     ) as bar:
         with open(fromPath, "rb") as f:
+            while offset < totalsize:
+                f.seek(offset)
+                data = f.read(chunk)
+                count = guestFileWrite(domain, handle, data)
+                if count == len(data):
+                    offset += count
+                    sent += count
+                    bar.update(count)
+                    failures = 0
+                    chunk = min(chunk * 2, limit)
+                    continue
+                failures += 1
+                countMetric("agent_write_retries")
+                if failures > GA_WRITE_RETRIES:
+                    break
+                chunk = max(chunk // 2, GA_CHUNK_MIN)
+                limit = min(limit, chunk)
+                if guestFileSeek(domain, handle, offset) != offset:
+                    break
+        status = {"execute": "guest-file-close", "arguments": {"handle": handle}}
+        qemuAgentCommand(domain, json.dumps(status), GA_WRITE_TIMEOUT, 0)
+    printRate("copy " + os.path.basename(fromPath), sent, time.time() - start)
+    countMetric("guest_bytes_sent", sent)
+    if offset < totalsize:
+        print("Transfer interrupted at offset " + str(offset) + ", rerun with --resume")
+        return None
+    hsum = sha256File(fromPath)
+    if not verify:
+        return hsum
+    gsum = guestSHA256(domain, toPath)
+    if gsum != hsum:
+        print("Checksum mismatch for " + toPath + ": " + str(gsum) + " != " + hsum)
+        return None
+    return hsum
+
+
+LARGE_FILE = 32 * 1024 * 1024
+
+
+def psQuote(s):
+    """Quote a string for a single-quoted PowerShell literal"""
+    return "'" + s.replace("'", "''") + "'"
+
+
+def normalizeTarInfo(ti):
+    """Drop the owner of a tar member so the archive only depends on the tree"""
+    ti.uid = ti.gid = 0
+    ti.uname = ti.gname = ""
+    return ti
+
+
+def largeFiles(fromPath, limit=LARGE_FILE):
+    """Return the sorted relative paths of the files under fromPath of at least limit bytes"""
+    large = []
+    for root, dirs, files in os.walk(fromPath):
+        for f in files:
+            path = os.path.join(root, f)
+            if os.path.getsize(path) >= limit:
+                large.append(os.path.relpath(path, fromPath))
+    return sorted(large)
+
+
+def packTree(fromPath, archive, limit=LARGE_FILE):
+    """
+    1. Walk fromPath recursively in sorted order.
+    2. Add every file smaller than limit to a gzip compressed tar at archive,
+       with a zero gzip mtime and no owners so the same tree packs to the same bytes.
+    3. Return the relative paths of the large files that were left out."""
+    large = []
+    with open(archive, "wb") as raw, gzip.GzipFile(
+        filename="", mode="wb", fileobj=raw, compresslevel=1, mtime=0
+    ) as gz, tarfile.open(fileobj=gz, mode="w") as mytar:
+        for root, dirs, files in os.walk(fromPath):
+            dirs.sort()
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                rel = os.path.relpath(path, fromPath)
+                if os.path.getsize(path) >= limit:
+                    large.append(rel)
+                else:
+                    mytar.add(path, rel.replace(os.sep, "/"), filter=normalizeTarInfo)
+    return large
+
+
+def copyTreeGA(domain, fromPath, toPath, tmpdir="workdir", resume=False):
+    """
+    1. Pack the small files of the tree into one archive on the host. With resume,
+       the archive left by an interrupted or failed run is sent again as is; it is
+       only removed once the guest has unpacked it.
+    2. Send the archive in one transfer and unpack it in the guest with tar.exe,
+       removing the guest copy only if tar succeeded.
+    3. Send the large files one after another; the agent channel of a domain
+       serializes commands, so parallel handles would not be faster.
+    4. Return True if every transfer was verified."""
+    os.makedirs(tmpdir, exist_ok=True)
+    start = time.time()
+    archive = os.path.join(tmpdir, "batchcopy.tar.gz")
+    if resume and os.path.exists(archive):
+        large = largeFiles(fromPath)
+    else:
+        large = packTree(fromPath, archive)
+    garchive = toPath + "hisck-batchcopy.tar.gz"
+    ok = copyFileGA(domain, archive, garchive, resume) is not None
+    dirs = {toPath} | {
+        toPath + os.path.dirname(rel).replace(os.sep, "\\") for rel in large
+    }
+    ps = "; ".join(
+        "New-Item -ItemType Directory -Force -Path " + psQuote(d) + " | Out-Null"
+        for d in sorted(dirs)
+    )
+    if ok:
+        ps += (
+            "; tar.exe -xzf "
+            + psQuote(garchive)
+            + " -C "
+            + psQuote(toPath)
+            + "; if ($LASTEXITCODE -ne 0) { exit $LASTEXITCODE }; Remove-Item -LiteralPath "
+            + psQuote(garchive)
+        )
+    result = runCmd(
+        domain,
+        "powershell.exe",
+        ["-NoProfile", "-InputFormat", "None", "-ExecutionPolicy", "Bypass", "-Command", ps],
+    )
+    code = result["return"].get("exitcode") if result is not None else None
+    if code != 0:
+        print("Unpacking %s in the guest failed with exit code %s" % (garchive, code))
+        ok = False
+    elif ok:
+        os.remove(archive)
+    for rel in large:
+        ok = (
+            copyFileGA(
+                domain,
+                os.path.join(fromPath, rel),
+                toPath + rel.replace(os.sep, "\\"),
+                resume,
+            )
+            is not None
+            and ok
+        )
+    print("batchcopy took %.1fs" % (time.time() - start))
+    return ok
+
+
+def copyFilesGA(domain,fromPath,toPath,resume=False,archive=False,tmpdir="workdir"):
+    if fromPath is None:
+        fromPath=os.path.join(os.getcwd(),"copy")
+
+    if archive:
+        return copyTreeGA(domain, fromPath, toPath, tmpdir, resume)
+    for f in os.listdir(fromPath):
+        copyFileGA(domain,os.path.join(fromPath,f),toPath+f,resume)
+
+def getStatus(domain, pid):
+    """Get the status of the command running in the guest"""
+    status = {"execute": "guest-exec-status", "arguments": {"pid": pid}}
+    result = qemuAgentCommand(domain, json.dumps(status))
+    return result
+
+
+POLL_MIN = 0.05
+POLL_MAX = 2.0
+POLL_FACTOR = 1.5
+GA_READ_COUNT = 1024 * 1024
+
+
+def pollIntervals(timeout=None):
+    """
+    1. Yield sleep intervals that start at POLL_MIN and grow by POLL_FACTOR up to POLL_MAX.
+    2. Stop before the deadline so the caller never sleeps past it.
+    3. Raise TimeoutError once timeout seconds have gone by."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    interval = POLL_MIN
+    while True:
+        if deadline is not None:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise TimeoutError("guest command did not finish in " + str(timeout) + "s")
+            interval = min(interval, left)
+        yield interval
+        interval = min(interval * POLL_FACTOR, POLL_MAX)
+
+
+def startCmd(domain, cmd, args, capture=True):
+    """Start a command in the guest and return its pid, or None if the agent refused it"""
+    payload = {
+        "execute": "guest-exec",
+        "arguments": {"path": str(cmd), "arg": args, "capture-output": capture},
+    }
+    result = qemuAgentCommand(domain, json.dumps(payload))
+    try:
+        return result["return"]["pid"]
+    except:
+        return None
+
+
+@timed("guestExec")
+def runCmd(domain, cmd, args, timeout=None, onOutput=None):
+    """
+    1. Run a command in the guest.
+    2. Poll guest-exec-status with exponential backoff until the command exits
+       or timeout seconds have gone by (TimeoutError).
+    3. With onOutput, stream stdout/stderr to onOutput(name, data) while the
+       command runs instead of returning them base64 encoded at the end.
+    4. Return the final guest-exec-status result, or None if it could not be started."""
+    if len(args) == 0:
+        args = []
+    if onOutput is not None:
+        out = None
+        for name, data in streamCmd(domain, cmd, args, timeout):
+            if name == "status":
+                out = data
+            else:
+                onOutput(name, data)
+        return out
+
+    pid = startCmd(domain, cmd, args)
+    if pid is None:
+        return None
+    for interval in pollIntervals(timeout):
+        out = getStatus(domain, pid)
+        if out is not None and out["return"]["exited"]:
+            return out
+        time.sleep(interval)
+
+
+def guestFileOpen(domain, path, mode):
+    """Open a file in the guest and return the handle, or None"""
+    status = {"execute": "guest-file-open", "arguments": {"path": path, "mode": mode}}
+    result = qemuAgentCommand(domain, json.dumps(status))
+    if result is None or "return" not in result:
+        return None
+    return result["return"]
+
+
+def guestFileRead(domain, handle, count=GA_READ_COUNT):
+    """Read what is currently available from an open guest file handle"""
+    status = {
+        "execute": "guest-file-read",
+        "arguments": {"handle": handle, "count": count},
+    }
+    result = qemuAgentCommand(domain, json.dumps(status))
+    if result is None or "return" not in result or result["return"]["count"] == 0:
+        return b""
+    return base64.b64decode(result["return"]["buf-b64"])
+
+
+def guestFileClose(domain, handle):
+    """Close an open guest file handle"""
+    status = {"execute": "guest-file-close", "arguments": {"handle": handle}}
+    return qemuAgentCommand(domain, json.dumps(status))
+
+
+def streamCmd(domain, cmd, args, timeout=None):
+    """
+    1. The agent only returns out-data/err-data once the process has exited, so
+       start the command from PowerShell with Start-Process, which redirects
+       stdout and stderr to temp files itself. The wrapper goes in as an
+       -EncodedCommand, so no shell ever re-parses the quoting; the command
+       line of the child is quoted with the CreateProcess rules it parses.
+       The wrapper caches the process handle before waiting: without it the
+       Process object of a redirected Start-Process has no ExitCode and every
+       command would exit 0.
+    2. While polling with backoff, read whatever was appended to the files and
+       yield ("out", bytes) / ("err", bytes) chunks.
+    3. Yield ("status", result) with the final guest-exec-status and remove the temp files."""
+    base = "C:\\Windows\\Temp\\hisck-" + os.urandom(4).hex()
+    files = {"out": base + ".out", "err": base + ".err"}
+    wrapper = "$p = Start-Process -FilePath %s" % psQuote(str(cmd))
+    if args:
+        wrapper += " -ArgumentList %s" % psQuote(subprocess.list2cmdline(list(args)))
+    wrapper += (
+        " -RedirectStandardOutput %s -RedirectStandardError %s"
+        " -NoNewWindow -PassThru; $null = $p.Handle; $p.WaitForExit(); exit $p.ExitCode"
+        % (psQuote(files["out"]), psQuote(files["err"]))
+    )
+    pid = startCmd(
+        domain,
+        "powershell.exe",
+        [
+            "-NoProfile",
+            "-NonInteractive",
+            "-ExecutionPolicy",
+            "Bypass",
+            "-EncodedCommand",
+            base64.b64encode(wrapper.encode("utf-16-le")).decode("ascii"),
+        ],
+        capture=False,
+    )
+    if pid is None:
+        yield ("status", None)
+        return
+    handles = {}
+    try:
+        for interval in pollIntervals(timeout):
+            out = getStatus(domain, pid)
+            exited = out is not None and out["return"]["exited"]
+            for name, path in files.items():
+                if name not in handles:
+                    h = guestFileOpen(domain, path, "rb")
+                    if h is None:
+                        continue
+                    handles[name] = h
+                while True:
+                    data = guestFileRead(domain, handles[name])
+                    if not data:
+                        break
+                    yield (name, data)
+            if exited:
+                yield ("status", out)
+                return
+            time.sleep(interval)
+    finally:
+        for h in handles.values():
+            guestFileClose(domain, h)
+        startCmd(domain, "cmd.exe", ["/c", "del", "/q", files["out"], files["err"]])
+
+
+READY_TIMEOUT = 1800
+PROBE_TIMEOUT = 2
+
+readyTimes = {}
+
+
+def pingAgent(domain):
+    """
+    1. Send guest-ping to check the agent is answering.
+    2. Send guest-sync with a random id to make sure the reply belongs to this
+       request and not to a stale one from before a reboot."""
+    if qemuAgentCommand(domain, '{"execute": "guest-ping"}', PROBE_TIMEOUT, 0) is None:
+        return False
+    syncid = int.from_bytes(os.urandom(4), "little")
+    status = {"execute": "guest-sync", "arguments": {"id": syncid}}
+    result = qemuAgentCommand(domain, json.dumps(status), PROBE_TIMEOUT, 0)
+    return result is not None and result.get("return") == syncid
+
+
+def guestFileExists(domain, path):
+    """Check if a file exists in the guest by opening it through the agent"""
+    h = guestFileOpen(domain, path, "rb")
+    if h is None:
+        return False
+    guestFileClose(domain, h)
+    return True
+
+
+def serviceRunning(domain, name):
+    """Check if a Windows service is running with sc.exe"""
+    result = runCmd(domain, "sc.exe", ["query", name], PROBE_TIMEOUT * 5)
+    if result is None or "out-data" not in result["return"]:
+        return False
+    return b"RUNNING" in base64.b64decode(result["return"]["out-data"])
+
+
+def waitForAgent(domain, phase, timeout=READY_TIMEOUT, services=(), files=()):
+    """
+    1. Probe the agent with guest-ping/guest-sync on a short backoff interval.
+    2. Once it answers, wait until every file in files exists and every service in services is running.
+    3. Record and print the time-to-ready for phase and return it."""
+    start = time.monotonic()
+    sys.stdout.write("Connecting to Guest")
+    for interval in pollIntervals(timeout):
+        if (
+            pingAgent(domain)
+            and all(guestFileExists(domain, f) for f in files)
+            and all(serviceRunning(domain, s) for s in services)
+        ):
+            break
+        sys.stdout.write(".")
+        sys.stdout.flush()
+        time.sleep(interval)
+    elapsed = time.monotonic() - start
+    readyTimes[phase] = elapsed
+    recordPhase("waitForAgent", elapsed, stage=phase)
+    print("\n%s: guest ready in %.1fs" % (phase, elapsed))
+    return elapsed
+
+
+CHOCO_CACHE = os.path.join("downloads", "choco")
+CHOCO_INSTALL_URL = "https://community.chocolatey.org/install.ps1"
+CHOCO_NUPKG_URL = "https://community.chocolatey.org/api/v2/package/chocolatey"
+CHOCO_GUEST_CACHE = "C:\\choco-cache"
+CHOCO_BATCH = 8
+CHOCO_DONE = re.compile(
+    r"The install of (\S+) was successful|^(\S+) not installed\.|^(\S+) v\S+ already installed",
+    re.MULTILINE,
+)
+
+
+def resolvePackages(path="requirements.txt"):
+    """
+    1. Read one chocolatey package per line, skipping blanks and # comments.
+    2. Accept name==version pins and drop duplicates, keeping the first.
+    3. Return a list of (name, version or None)."""
+    packages = {}
+    with open(path) as file:
+        for line in file:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            name, _, version = line.partition("==")
+            packages.setdefault(name.strip(), version.strip() or None)
+    return list(packages.items())
+
+
+def chocoBatches(packages, size=CHOCO_BATCH):
+    """Group unpinned packages into choco invocations of at most size packages;
+    a pinned package gets its own invocation with --version"""
+    unpinned = [n for n, v in packages if v is None]
+    batches = [unpinned[i : i + size] for i in range(0, len(unpinned), size)]
+    batches += [[n, "--version", v] for n, v in packages if v is not None]
+    return batches
+
+
+def networkHost(conn, network="default"):
+    """Return the host address on a libvirt network, or None"""
+    try:
+        net = conn.networkLookupByName(network)
+    except libvirt.libvirtError:
+        return None
+    ip = ET.fromstring(net.XMLDesc(0)).find("ip")
+    return ip.get("address") if ip is not None else None
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serveDirectory(path, host):
+    """Serve path read-only over HTTP on host from a daemon thread and return the server"""
+    handler = functools.partial(QuietHandler, directory=path)
+    server = http.server.ThreadingHTTPServer((host, 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def pullFileGA(domain, fromPath, toPath):
+    """Copy a file from the guest to the host over the agent and return its size"""
+    handle = guestFileOpen(domain, fromPath, "rb")
+    if handle is None:
+        return None
+    size = 0
+    try:
+        with open(toPath, "wb") as f:
             while True:
-                data = f.read(1024 * 32)
-                bar.update(len(data))
+                data = guestFileRead(domain, handle, GA_READ_COUNT)
                 if not data:
                     break
-                status = {
-                    "execute": "guest-file-write",
-                    "arguments": {
-                        "handle": handle,
-                        "buf-b64": base64.b64encode(data).decode("utf-8"),
-                    },
-                }
-                result = qemuAgentCommand(domain, json.dumps(status))
-        status = {"execute": "guest-file-close", "arguments": {"handle": handle}}
-        result = qemuAgentCommand(domain, json.dumps(status))
+                f.write(data)
+                size += len(data)
+    finally:
+        guestFileClose(domain, handle)
+    countMetric("guest_bytes_received", size)
+    return size
+
+
+def openChocoFeed(conn):
+    """
+    1. Cache the chocolatey bootstrap (install.ps1 and its nupkg) in the host cache.
+    2. Pack the cached nupkgs and serve the cache on the libvirt network.
+    3. Return (server, base url), or (None, None) when the network has no host address."""
+    os.makedirs(CHOCO_CACHE, exist_ok=True)
+    host = networkHost(conn)
+    if host is None:
+        return None, None
+    for url, name in [
+        (CHOCO_INSTALL_URL, "install.ps1"),
+        (CHOCO_NUPKG_URL, "chocolatey.nupkg"),
+    ]:
+        cachedDownload(url, os.path.join("choco", name), 1)
+    with tarfile.open(os.path.join(CHOCO_CACHE, "feed.tar"), "w") as mytar:
+        for nupkg in glob.glob(os.path.join(CHOCO_CACHE, "packages", "*.nupkg")):
+            mytar.add(nupkg, os.path.basename(nupkg))
+    server = serveDirectory(CHOCO_CACHE, host)
+    return server, "http://%s:%d/" % (host, server.server_port)
+
+
+@timed("installChocolatey")
+def installChocolatey(dom, feed=None):
+    """Install chocolatey in the guest, bootstrapping from the host feed when there is one"""
+    script = "iex ((New-Object System.Net.WebClient).DownloadString(%s))" % psQuote(
+        CHOCO_INSTALL_URL if feed is None else feed + "install.ps1"
+    )
+    if feed is not None:
+        script = (
+            "$env:chocolateyDownloadUrl = %s; " % psQuote(feed + "chocolatey.nupkg")
+            + script
+        )
+    return runPS1(
+        dom,
+        "[System.Net.ServicePointManager]::SecurityProtocol = 3072; " + script,
+        onOutput=writeOutput,
+    )
+
+
+def syncChocoFeed(dom, feed):
+    """Unpack the host's cached nupkgs into the guest and use them as the first choco source"""
+    return runPS1(
+        dom,
+        (
+            "New-Item -ItemType Directory -Force -Path %s | Out-Null; "
+            "curl.exe -sf -o C:\\Windows\\Temp\\feed.tar %s; "
+            "tar.exe -xf C:\\Windows\\Temp\\feed.tar -C %s; "
+            "choco.exe source add -n=hisck -s=%s --priority=1"
+        )
+        % (
+            psQuote(CHOCO_GUEST_CACHE),
+            psQuote(feed + "feed.tar"),
+            psQuote(CHOCO_GUEST_CACHE),
+            CHOCO_GUEST_CACHE,
+        ),
+        onOutput=writeOutput,
+    )
+
+
+@timed("harvestNupkgs")
+def harvestNupkgs(dom, tmpdir):
+    """Pull the nupkgs chocolatey kept in the guest into the host cache and return how many were new"""
+    gtar = "C:\\Windows\\Temp\\harvest.tar"
+    runPS1(
+        dom,
+        "$d = 'C:\\Windows\\Temp\\harvest'; New-Item -ItemType Directory -Force -Path $d | Out-Null; "
+        "Get-ChildItem C:\\ProgramData\\chocolatey\\lib -Recurse -Filter *.nupkg | Copy-Item -Destination $d -Force; "
+        "tar.exe -cf " + gtar + " -C $d .",
+    )
+    archive = os.path.join(tmpdir, "harvest.tar")
+    if not pullFileGA(dom, gtar, archive):
+        return 0
+    dest = os.path.join(CHOCO_CACHE, "packages")
+    os.makedirs(dest, exist_ok=True)
+    new = 0
+    with tarfile.open(archive) as mytar:
+        for member in mytar.getmembers():
+            name = os.path.basename(member.name)
+            if member.isfile() and name.endswith(".nupkg"):
+                if not os.path.exists(os.path.join(dest, name)):
+                    new += 1
+                with mytar.extractfile(member) as src, open(
+                    os.path.join(dest, name), "wb"
+                ) as of:
+                    shutil.copyfileobj(src, of)
+    os.remove(archive)
+    print("Cached %d new packages" % new)
+    return new
+
+
+def recordPackage(tmpdir, package, seconds, status, batch):
+    """Append the install time of a package to choco-stats.jsonl"""
+    entry = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "package": package,
+        "seconds": seconds,
+        "status": status,
+        "batch": batch,
+    }
+    with open(os.path.join(tmpdir, "choco-stats.jsonl"), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    return entry
+
+
+@timed("installPackages")
+def installPackages(dom, tmpdir, requirements="requirements.txt", size=CHOCO_BATCH):
+    """
+    1. Resolve requirements into batched choco invocations.
+    2. Stream each batch's output and time every package from the end of the previous
+       one to its "install of ... was successful" (or not installed) line.
+    3. Record per-package times in choco-stats.jsonl and return the failed packages,
+       counting a package with no result line as failed."""
+    os.makedirs(tmpdir, exist_ok=True)
+    failed = []
+    for i, batch in enumerate(chocoBatches(resolvePackages(requirements), size)):
+        names = [batch[0]] if "--version" in batch else batch
+        print("Installing " + " ".join(names))
+        marks = {}
+        last = [time.time()]
+        pending = [""]
+
+        def onOutput(name, data):
+            writeOutput(name, data)
+            if name != "out":
+                return
+            text = pending[0] + data.decode("utf-8", "replace")
+            text, _, pending[0] = text.rpartition("\n")
+            for m in CHOCO_DONE.finditer(text):
+                pkg = next(g for g in m.groups() if g)
+                now = time.time()
+                marks[pkg.lower()] = (now - last[0], "ok" if m.group(2) is None else "failed")
+                last[0] = now
+
+        start = time.time()
+        try:
+            result = runCmd(
+                dom,
+                "choco.exe",
+                ["install"] + batch + ["-y", "--no-progress"],
+                onOutput=onOutput,
+            )
+            code = result["return"].get("exitcode") if result is not None else None
+        except TimeoutError:
+            code = None
+        elapsed = time.time() - start
+        for pkg in names:
+            seconds, status = marks.get(pkg.lower(), (None, "unknown"))
+            # without an "install ... was successful" line the package did not install,
+            # whatever the batch exit code says
+            if status != "ok":
+                status = "failed"
+                failed.append(pkg)
+            recordPackage(tmpdir, pkg, seconds, status, i)
+            recordPhase("package", seconds or 0.0, status == "ok", package=pkg)
+            print("  %s: %s %s" % (pkg, status, "%.1fs" % seconds if seconds else ""))
+        print("Batch %d finished in %.1fs (exit code %s)" % (i, elapsed, code))
+    if failed:
+        print("Failed packages: " + ", ".join(failed))
+    return failed
+
+
+LAYER_DIR = "layers"
+LAYER_INDEX = os.path.join(LAYER_DIR, "layers.json")
+
+
+def treeDigest(path):
+    """Return a SHA-256 over the relative names and contents of every file under path"""
+    h = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for f in sorted(files):
+            full = os.path.join(root, f)
+            h.update(os.path.relpath(full, path).encode("utf-8") + b"\0")
+            h.update(bytes.fromhex(sha256File(full)))
+    return h.hexdigest()
+
+
+def layerKey(parent, step, inputs):
+    """Hash a build step's name and inputs together with its parent layer's key"""
+    data = json.dumps([parent, step, inputs], sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def sourceInputs(inputfile):
+    """Identify the source download by its manifest SHA-256, or by name, size and mtime"""
+    with lockedState(DOWNLOAD_MANIFEST) as manifest:
+        entry = manifest.get(os.path.basename(inputfile))
+    if entry is not None and cacheValid(entry, inputfile):
+        return entry["sha256"]
+    st = os.stat(inputfile)
+    return [os.path.basename(inputfile), st.st_size, st.st_mtime_ns]
+
+
+@timed("offlineStep")
+def offlineStep(d, conn, tmpdir, layer, chain, tskscan=False, regspec=None):
+    """Apply the registry spec and copy the startup files into layer with it mounted on the host"""
+    connectNBD(d, layer).decode("utf-8")
+    try:
+        if tskscan:
+            sconn = sqlite3.connect(chain[-1] + ".db")
+            mountdev = getMountDev(sconn, d)
+        else:
+            mountdev = locateMountDev(d)
+        mountWin(mountdev)
+        try:
+            print("Editing registry")
+            applyRegistrySpec(loadRegistrySpec(regspec))
+            print("Copying files")
+            copyFiles()
+        finally:
+            umountWin(mountdev)
+    finally:
+        disconnectNBD(d).decode("utf-8")
+
+
+def bootStep(conn, tag, layer, chain, phase):
+    """Define the template domain on layer and boot it until the agent answers"""
+    dom = bootVM(defineXML(tag, chain, layer), conn)
+    waitForAgent(dom, phase)
+    return dom
+
+
+def chocolateyStep(d, conn, tmpdir, layer, chain, tag):
+    """Boot layer, install chocolatey from the host feed and shut down; raise if the
+    install failed so the layer is not recorded"""
+    dom = bootStep(conn, tag, layer, chain, "boot")
+    server, feed = openChocoFeed(conn)
+    try:
+        print("Calling powershell to intall chocolatey")
+        result = installChocolatey(dom, feed)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    shutdownDomain(dom)
+    code = result["return"].get("exitcode") if isinstance(result, dict) else None
+    if code != 0:
+        raise RuntimeError("Installing chocolatey failed with exit code %s" % code)
+
+
+def packagesStep(d, conn, tmpdir, layer, chain, tag):
+    """Boot layer, install the requirements, cache their nupkgs and shut down; raise
+    if a package failed so the layer is not recorded"""
+    dom = bootStep(conn, tag, layer, chain, "boot")
+    server, feed = openChocoFeed(conn)
+    try:
+        if feed is not None:
+            syncChocoFeed(dom, feed)
+        failed = installPackages(dom, tmpdir)
+        harvestNupkgs(dom, tmpdir)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    print("Shutting down...")
+    shutdownDomain(dom)
+    if failed:
+        raise RuntimeError("Packages failed to install: " + ", ".join(failed))
+
+
+def buildLayer(d, conn, tmpdir, step, key, parent, run):
+    """
+    1. Reuse layers/<step>-<key>.qcow2 if layers.json records it as complete.
+    2. Otherwise create it as an overlay of parent, run the step into it, index the
+       files it changed against the parent's index and record it as complete.
+       A step that raises leaves nothing behind, so the next build runs it again.
+    3. Return (path, hit, seconds)."""
+    os.makedirs(LAYER_DIR, exist_ok=True)
+    layer = os.path.join(LAYER_DIR, "%s-%s.qcow2" % (step, key))
+    with lockedState(LAYER_INDEX) as index:
+        done = key in index and os.path.exists(layer)
+    if done:
+        countMetric("layer_cache_hits")
+        recordPhase("layer", 0.0, step=step, cached=True)
+        return layer, True, 0.0
+    countMetric("layer_cache_misses")
+    start = time.time()
+    chain = backingChain(parent)
+    parentdb = ensureIndex(d, parent)
+    createBaseInstanceQCOW2(os.path.abspath(parent), layer[: -len(".qcow2")])
+    try:
+        run(d, conn, tmpdir, layer, [os.path.abspath(p) for p in chain])
+    except BaseException:
+        os.remove(layer)
+        raise
+    connectNBD(d, layer, readonly=True)
+    try:
+        indexOverlay(d, layer, layer + ".delta.db", parentdb)
+    finally:
+        disconnectNBD(d)
+    elapsed = time.time() - start
+    recordPhase("layer", elapsed, step=step, cached=False)
+    with lockedState(LAYER_INDEX) as index:
+        index[key] = {
+            "step": step,
+            "parent": os.path.abspath(parent),
+            "path": os.path.abspath(layer),
+            "built": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seconds": elapsed,
+        }
+    return layer, False, elapsed
+
+
+@timed("createCustomizedImage")
+def createCustomizedImage(
+    f, tag, tmpdir, d, conn, tskscan=False, regspec=None, basekey=None
+):
+    """
+    1. Build the template as a chain of layers on top of the base image f:
+       offline edits, chocolatey, packages. Each layer is keyed by a hash of
+       its inputs and its parent's key.
+    2. Reuse the longest chain of cached layers and run only the steps after it.
+    3. Put an empty <tag>.qcow2 overlay on the last layer for instances to
+       back onto, define the template domain and index it.
+    4. Print which steps hit the cache and which ran, and return <tag>.qcow2."""
+    dbname = f + ".db"
+    if tskscan and not os.path.exists(dbname):
+        print("Creating SQL DB")
+        connectNBD(d, f).decode("utf-8")
+        print(runFdisk(d).decode("utf-8"))
+        createSQLite(d, dbname).decode("utf-8")
+        disconnectNBD(d).decode("utf-8")
+
+    steps = [
+        (
+            "offline",
+            [loadRegistrySpec(regspec), treeDigest(os.path.join(os.getcwd(), "startup"))],
+            lambda d, conn, tmpdir, layer, chain: offlineStep(
+                d, conn, tmpdir, layer, chain, tskscan, regspec
+            ),
+        ),
+        (
+            "chocolatey",
+            [CHOCO_INSTALL_URL],
+            lambda d, conn, tmpdir, layer, chain: chocolateyStep(
+                d, conn, tmpdir, layer, chain, tag
+            ),
+        ),
+        (
+            "packages",
+            resolvePackages(),
+            lambda d, conn, tmpdir, layer, chain: packagesStep(
+                d, conn, tmpdir, layer, chain, tag
+            ),
+        ),
+    ]
+    parent, key = f, basekey or layerKey(None, "base", os.path.abspath(f))
+    report = []
+    for step, inputs, run in steps:
+        key = layerKey(key, step, inputs)
+        parent, hit, elapsed = buildLayer(d, conn, tmpdir, step, key, parent, run)
+        report.append((step, key, hit, elapsed))
+
+    iname = tag
+    parentdb = None if tskscan else ensureIndex(d, parent)
+    iqcow2 = createBaseInstanceQCOW2(os.path.abspath(parent), iname)
+    defineVM(defineXML(iname, backingChain(iqcow2)[1:], iqcow2), conn)
+
+    print(connectNBD(d, iqcow2).decode("utf-8"))
+    print(runFdisk(d).decode("utf-8"))
+    if tskscan:
+        print(createSQLite(d, iqcow2 + ".db").decode("utf-8"))
+    else:
+        indexOverlay(d, iqcow2, iqcow2 + ".delta.db", parentdb)
+    mountdev = locateMountDev(d)
+    mountWin(mountdev)
+    try:
+        virtioBoot = bootDriverInstalled(VIRTIO_BOOT_DRIVER)
+    finally:
+        umountWin(mountdev)
+    print(disconnectNBD(d).decode("utf-8"))
+    if virtioBoot:
+        open(iqcow2 + VIRTIO_BOOT_MARKER, "w").close()
+    elif os.path.exists(iqcow2 + VIRTIO_BOOT_MARKER):
+        os.remove(iqcow2 + VIRTIO_BOOT_MARKER)
+    print("virtio-blk boot: " + ("yes" if virtioBoot else "no, viostor is not installed"))
+
+    for step, key, hit, elapsed in report:
+        print(
+            "%-12s %s %s"
+            % (step, key, "cached" if hit else "built in %.1fs" % elapsed)
+        )
+    return iqcow2
+
+
+@timed("launchSubInstance")
+def launchSubInstance(
+    name,
+    conn,
+    memory=None,
+    vcpus=None,
+    ioprofile="default",
+    snap=False,
+    maxdepth=CHAIN_MAX_DEPTH,
+):
+    """Launch an instance built from the customized image"""
+    iname = findInstanceName(name, conn)
+    print(iname)
+    bf1 = templateImage(name, maxdepth, conn)
+    iqcow2 = createBaseInstanceQCOW2(bf1, iname)
+    print(iqcow2)
+    dxl = defineXML(iname, backingChain(bf1), iqcow2, memory, vcpus, ioprofile)
+    dom = bootVM(dxl, conn)
+    if snap:
+        waitForAgent(dom, "boot")
+        snapshot(dom, POSTINSTALL_SNAPSHOT, "Booted and ready.")
+    return dom
+
+
+async def bootDomainAsync(dom, timeout=REBOOT_TIMEOUT):
+    """Start a defined domain and return once libvirt reports it started"""
+    await waitDomainEvent(dom, libvirt.VIR_DOMAIN_EVENT_STARTED, dom.create, timeout)
+    return dom
+
+
+@timed("launchFleet")
+def launchFleet(
+    name,
+    conn,
+    count,
+    jobs=4,
+    memory=None,
+    vcpus=None,
+    ioprofile="default",
+    maxdepth=CHAIN_MAX_DEPTH,
+):
+    """
+    1. Allocate count free instance names with one listAllDomains call.
+    2. Create the qcow2 overlays and define the domains in parallel.
+    3. Boot the domains, at most jobs at a time.
+    4. Print the total and per-instance launch times and return the domains."""
+    start = time.time()
+    bf1 = templateImage(name, maxdepth, conn)
+    chain = backingChain(bf1)
+    names = allocateInstanceNames(name, conn, count)
+    started = {}
+
+    def prepare(iname):
+        started[iname] = time.time()
+        iqcow2 = createBaseInstanceQCOW2(bf1, iname)
+        dxl = defineXML(iname, chain, iqcow2, memory, vcpus, ioprofile)
+        return defineVM(dxl, conn)
+
+    async def boot(dom):
+        await bootDomainAsync(dom)
+        print("%s launched in %.1fs" % (dom.name(), time.time() - started[dom.name()]))
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        doms = list(pool.map(prepare, names))
+    runOnLoop(gatherLimited([boot(d) for d in doms], jobs))
+    print("%d instances launched in %.1fs" % (count, time.time() - start))
+    return doms
+
+
+WARMPOOL_STATE = "warmpool.json"
+
+
+@contextmanager
+def lockedState(path):
+    """Load a JSON state file under an exclusive lock and write it back afterwards"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        data = f.read()
+        state = json.loads(data) if data else {}
+        yield state
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state, indent=1))
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def poolEntry(state, template):
+    """Return the pool record of template, creating an empty one"""
+    entry = state.setdefault(
+        template,
+        {"mode": "save", "ready": [], "hits": 0, "misses": 0, "latencies": []},
+    )
+    pending = entry.setdefault("pending", {})
+    # drop the reservations of fill processes that died before releasing them
+    for name, pid in list(pending.items()):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            del pending[name]
+    return entry
+
+
+def warmClone(conn, template, name, mode="save", maxdepth=CHAIN_MAX_DEPTH):
+    """
+    1. Create the overlay and domain for a pool clone of template, whose name
+       fillPool reserved as pending.
+    2. Boot it to agent readiness.
+    3. Managed-save it (mode save) or pause it (mode pause) and move it from
+       pending to ready; release the reservation if any step fails."""
+    try:
+        bf1 = templateImage(template, maxdepth, conn)
+        iqcow2 = createBaseInstanceQCOW2(bf1, name)
+        dom = defineVM(defineXML(name, backingChain(bf1), iqcow2), conn)
+        runOnLoop(bootDomainAsync(dom))
+        waitForAgent(dom, "warm")
+        if mode == "save":
+            dom.managedSave(0)
+        else:
+            dom.suspend()
+    except BaseException:
+        with lockedState(WARMPOOL_STATE) as state:
+            poolEntry(state, template)["pending"].pop(name, None)
+        raise
+    with lockedState(WARMPOOL_STATE) as state:
+        entry = poolEntry(state, template)
+        entry["pending"].pop(name, None)
+        entry["ready"].append(name)
+    return dom
+
+
+def fillPool(
+    conn, template, size, budget, mode="save", jobs=4, maxdepth=CHAIN_MAX_DEPTH
+):
+    """
+    1. Work out how many clones are missing from the pool, counting the ones
+       other fill processes are still booting.
+    2. Keep within the memory budget (MiB): paused clones hold their memory,
+       saved clones only need it while they boot.
+    3. Reserve the names and slots in the pool state under its lock, flatten the
+       template once, boot the clones in parallel and return how many were added."""
+    dommem = conn.lookupByName(template).info()[1] // 1024
+    slots = budget // dommem
+    with lockedState(WARMPOOL_STATE) as state:
+        entry = poolEntry(state, template)
+        entry["mode"] = mode
+        ready = len(entry["ready"])
+        pending = entry["pending"]
+        need = size - ready - len(pending)
+        if need <= 0:
+            return 0
+        slots -= len(pending)
+        if mode == "pause":
+            need = min(need, slots - ready)
+            slots = need
+        workers = min(jobs, slots, need)
+        if workers > 0:
+            names = allocateInstanceNames(
+                template + "-warm", conn, need, list(entry["ready"]) + list(pending)
+            )
+            pending.update((n, os.getpid()) for n in names)
+    if workers <= 0:
+        print("Memory budget of %d MiB leaves no room for another clone" % budget)
+        return 0
+    try:
+        templateImage(template, maxdepth, conn)
+    except BaseException:
+        with lockedState(WARMPOOL_STATE) as state:
+            pending = poolEntry(state, template)["pending"]
+            for n in names:
+                pending.pop(n, None)
+        raise
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda n: warmClone(conn, template, n, mode, maxdepth), names))
+    print("Added %d clones to the %s pool" % (need, template))
+    return need
+
+
+@timed("handOut")
+def handOut(conn, template, maxdepth=CHAIN_MAX_DEPTH):
+    """
+    1. Take the oldest ready clone from the pool and restore or resume it.
+    2. If the pool is empty, fall back to a cold launch.
+    3. Record the hit/miss and the hand-out latency, print them and return the domain."""
+    start = time.time()
+    with lockedState(WARMPOOL_STATE) as state:
+        entry = poolEntry(state, template)
+        name = entry["ready"].pop(0) if entry["ready"] else None
+        mode = entry["mode"]
+    if name is not None:
+        dom = conn.lookupByName(name)
+        if mode == "save":
+            dom.create()
+        else:
+            dom.resume()
+    else:
+        dom = launchSubInstance(template, conn, maxdepth=maxdepth)
+    waitForAgent(dom, "handout")
+    latency = time.time() - start
+    with lockedState(WARMPOOL_STATE) as state:
+        entry = poolEntry(state, template)
+        entry["hits" if name is not None else "misses"] += 1
+        entry["latencies"] = (entry["latencies"] + [latency])[-1000:]
+    print(
+        "%s handed out in %.1fs (%s)"
+        % (dom.name(), latency, "hit" if name is not None else "miss")
+    )
+    sys.stdout.flush()
+    return dom
+
+
+def poolStatus(template):
+    """Print the ready clones, hit rate and hand-out latency of a pool"""
+    with lockedState(WARMPOOL_STATE) as state:
+        entry = poolEntry(state, template)
+    total = entry["hits"] + entry["misses"]
+    lat = sorted(entry["latencies"])
+    print("ready: %d (%s)" % (len(entry["ready"]), ", ".join(entry["ready"])))
+    print(
+        "hits: %d misses: %d hit rate: %.0f%%"
+        % (entry["hits"], entry["misses"], 100.0 * entry["hits"] / total if total else 0)
+    )
+    if lat:
+        print(
+            "latency mean %.1fs p50 %.1fs p95 %.1fs"
+            % (
+                sum(lat) / len(lat),
+                lat[len(lat) // 2],
+                lat[min(len(lat) - 1, int(len(lat) * 0.95))],
+            )
+        )
+
+
+def refillDetached(conn, template, size, budget, mode, jobs, maxdepth):
+    """Start a "warmpool --poolaction fill" run for template in its own session, so
+    it keeps booting clones after this process has exited; it logs to warmpool-refill.log"""
+    cl = [
+        sys.executable,
+        os.path.abspath(sys.argv[0]),
+        "warmpool",
+        "--poolaction",
+        "fill",
+        "--tag",
+        template,
+        "--poolsize",
+        str(size),
+        "--poolbudget",
+        str(budget),
+        "--poolmode",
+        mode,
+        "--jobs",
+        str(jobs),
+        "--maxdepth",
+        str(maxdepth),
+        "--uri",
+        conn.getURI(),
+    ]
+    with open("warmpool-refill.log", "a") as log:
+        p = subprocess.Popen(
+            cl,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    print("Refilling the %s pool in the background (pid %d)" % (template, p.pid))
+    return p.pid
+
+
+def warmPool(
+    conn, action, template, size, budget, mode, jobs, interval, maxdepth=CHAIN_MAX_DEPTH
+):
+    """Run a warm pool action: fill, get (then refill in the background), status or
+    serve (refill forever)"""
+    match action:
+        case "fill":
+            fillPool(conn, template, size, budget, mode, jobs, maxdepth)
+        case "get":
+            handOut(conn, template, maxdepth)
+            refillDetached(conn, template, size, budget, mode, jobs, maxdepth)
+        case "status":
+            poolStatus(template)
+        case "serve":
+            while True:
+                fillPool(conn, template, size, budget, mode, jobs, maxdepth)
+                time.sleep(interval)
+
 
-def copyFilesGA(domain,fromPath,toPath):
-    if fromPath is None:
-        fromPath=os.path.join(os.getcwd(),"copy")
-    
-    for f in os.listdir(fromPath):
-        copyFileGA(domain,os.path.join(fromPath,f),toPath+f)
+DOWNLOAD_SEGMENTS = 8
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60
+httpSessionLocal = threading.local()
 
-def getStatus(domain, pid):
-    """Get the status of the command running in the guest"""
-    status = {"execute": "guest-exec-status", "arguments": {"pid": pid}}
-    result = qemuAgentCommand(domain, json.dumps(status))
-    return result
 
+def httpSession(pool=DOWNLOAD_SEGMENTS):
+    """Return this thread's pooled requests Session"""
+    s = getattr(httpSessionLocal, "session", None)
+    if s is None:
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        httpSessionLocal.session = s
+    return s
 
-def runCmd(domain, cmd, args):
-    """Run a command in the guest"""
-    if len(args) == 0:
-        args = []
-    payload = {
-        "execute": "guest-exec",
-        "arguments": {"path": str(cmd), "arg": args, "capture-output": True},
-    }
 
-    result = qemuAgentCommand(domain, json.dumps(payload))
+def loadPartState(statepath, url, size):
+    """Return the segment list of a partial download, or None if it is for another url/size"""
     try:
-        pid = result["return"]["pid"]
-    except:
+        with open(statepath) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
         return None
-    cmddone = False
-    while not cmddone:
-        out = getStatus(domain, pid)
-        cmddone = out["return"]["exited"]
-    return out
+    if state.get("url") != url or state.get("size") != size:
+        return None
+    return state["segments"]
 
-def createCustomizedImage(f, tag, tmpdir, d, conn):
-    """Create a image for customization from the inputfile"""
-    dbname = f + ".db"
-    if not os.path.exists(dbname):
-        print("Creating SQL DB")
-        connectNBD(d, f).decode("utf-8")
-        print(runFdisk(d).decode("utf-8"))
-        createSQLite(d, dbname).decode("utf-8")
-        disconnectNBD(d).decode("utf-8")
 
-    iname = tag
-    iqcow2 = createBaseInstanceQCOW2(f, iname)
+def fetchSegment(session, url, fd, seg, bar, lock, save):
+    """
+    1. Request the remaining bytes of seg ([start, end, done]) with a Range header.
+    2. pwrite each chunk at its offset and advance seg's done counter.
+    3. Retry from the last written byte on connection errors."""
+    for attempt in range(DOWNLOAD_RETRIES):
+        start, end, done = seg
+        if start + done > end:
+            return
+        try:
+            with session.get(
+                url,
+                headers={"Range": "bytes=%d-%d" % (start + done, end)},
+                stream=True,
+                timeout=DOWNLOAD_TIMEOUT,
+            ) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise ValueError("Server ignored the Range request")
+                pending = 0
+                for chunk in r.iter_content(chunk_size=COPY_BLOCKSIZE):
+                    os.pwrite(fd, chunk, start + seg[2])
+                    countMetric("download_bytes", len(chunk))
+                    with lock:
+                        seg[2] += len(chunk)
+                        bar.update(len(chunk))
+                    pending += len(chunk)
+                    if pending >= PROGRESS_INTERVAL:
+                        save()
+                        pending = 0
+            if start + seg[2] > end:
+                return
+        except requests.exceptions.RequestException as e:
+            print("Segment %d-%d: %s, retrying (%d)" % (start, end, e, attempt + 1))
+            countMetric("download_retries")
+            time.sleep(2**attempt)
+    raise IOError("Segment %d-%d of %s failed" % (seg[0], seg[1], url))
 
-    sconn = sqlite3.connect(dbname)
 
-    connectNBD(d, iqcow2).decode("utf-8")
-    mountdev = getMountDev(sconn, d)
-    mountWin(mountdev)
+def downloadStream(session, url, part, size, bar, ranges):
+    """Download into part with one GET, appending to it when the server supports ranges"""
+    offset = os.path.getsize(part) if ranges and os.path.exists(part) else 0
+    headers = {"Range": "bytes=%d-" % offset} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            offset = 0
+        bar.update(offset)
+        with open(part, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            for chunk in r.iter_content(chunk_size=COPY_BLOCKSIZE):
+                f.write(chunk)
+                bar.update(len(chunk))
+                countMetric("download_bytes", len(chunk))
+    if size is not None and os.path.getsize(part) != size:
+        raise IOError("Short download of %s" % url)
 
-    print("Disabling UAC")
-    disableUAC()
-    print("Copying files")
-    copyFiles()
 
-    umountWin(mountdev)
-    disconnectNBD(d).decode("utf-8")
+@timed("download")
+def downloadUrl(url, dest, segments=DOWNLOAD_SEGMENTS, sha256=None):
+    """
+    1. HEAD the url for its size and whether it accepts byte ranges.
+    2. With ranges, split it into segments fetched in parallel on a pooled Session.
+       Progress is kept in dest.part.json so an interrupted download resumes.
+    3. Otherwise stream it with one GET, resuming dest.part if possible.
+    4. Check the SHA-256 if given, move the file into place and return its digest."""
+    session = httpSession(segments)
+    head = session.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+    head.raise_for_status()
+    url = head.url
+    size = head.headers.get("Content-Length")
+    size = int(size) if size is not None else None
+    ranges = head.headers.get("Accept-Ranges", "").lower() == "bytes" and bool(size)
+    part = dest + ".part"
+    statepath = part + ".json"
 
-    dxl = defineXML(iname, [f], iqcow2)
-    #snapshot(iname,'initial','Initial Snapshot')
-    print("Booting VM")
-    dom = bootVM(dxl, conn)
+    start = time.time()
+    with tqdm(
+        desc=dest, total=size, unit="B", unit_scale=True, unit_divisor=1024
+    ) as bar:
+        if ranges and segments > 1:
+            segs = loadPartState(statepath, url, size) if os.path.exists(part) else None
+            if segs is None:
+                step = -(-size // segments)
+                segs = [[o, min(o + step, size) - 1, 0] for o in range(0, size, step)]
+                with open(part, "wb") as f:
+                    f.truncate(size)
+            bar.update(sum(seg[2] for seg in segs))
+            lock = threading.Lock()
 
-    result = None
-    sys.stdout.write("Connecting to Guest")
-    while result is None:
-        result = runCmd(dom, "cmd", ["/c", "whoami"])
-        sys.stdout.write(".")
-        sys.stdout.flush()
-        time.sleep(5)
-    print(result)
-    print(base64.b64decode(result["return"]["out-data"]))
+            def save():
+                # one writer at a time, and never a half written state file
+                with lock:
+                    with open(statepath + ".tmp", "w") as f:
+                        json.dump({"url": url, "size": size, "segments": segs}, f)
+                    os.replace(statepath + ".tmp", statepath)
 
-    print("Calling powershell to intall chocolatey")
-    result = runCmd(
-        dom,
-        "powershell.exe",
-        [
-            "-NoProfile",
-            "-InputFormat",
-            "None",
-            "-ExecutionPolicy",
-            "Bypass",
-            "-Command",
-            "[System.Net.ServicePointManager]::SecurityProtocol = 3072; iex ((New-Object System.Net.WebClient).DownloadString('https://community.chocolatey.org/install.ps1'))",
-        ],
+            save()
+            fd = os.open(part, os.O_WRONLY)
+            try:
+                with ThreadPoolExecutor(max_workers=len(segs)) as pool:
+                    futures = [
+                        pool.submit(
+                            lambda seg: fetchSegment(
+                                httpSession(segments), url, fd, seg, bar, lock, save
+                            ),
+                            seg,
+                        )
+                        for seg in segs
+                    ]
+                    for fut in futures:
+                        fut.result()
+            finally:
+                os.close(fd)
+                save()
+        else:
+            downloadStream(session, url, part, size, bar, ranges)
+
+    printRate("Downloaded " + dest, os.path.getsize(part), time.time() - start)
+    digest = sha256File(part)
+    if sha256 is not None and digest != sha256.lower():
+        os.remove(part)
+        if os.path.exists(statepath):
+            os.remove(statepath)
+        raise ValueError("SHA-256 mismatch for %s: %s" % (dest, digest))
+    os.replace(part, dest)
+    if os.path.exists(statepath):
+        os.remove(statepath)
+    return digest
+
+
+DOWNLOAD_DIR = "downloads"
+DOWNLOAD_MANIFEST = os.path.join(DOWNLOAD_DIR, "manifest.json")
+DOWNLOAD_OBJECTS = os.path.join(DOWNLOAD_DIR, "objects")
+
+
+def cacheValid(entry, dest):
+    """True if dest exists with the size recorded in its manifest entry"""
+    return (
+        entry is not None
+        and os.path.exists(dest)
+        and os.path.getsize(dest) == entry["size"]
     )
-    print(result)
-    print(base64.b64decode(result["return"]["out-data"]))
 
-    print("Shutting down...")
-    dom.reboot()
-    
-    result = None
-    sys.stdout.write("Connecting to Guest")
-    while result is None:
-        result = runCmd(dom, "cmd", ["/c", "whoami"])
-        sys.stdout.write(".")
-        sys.stdout.flush()
-        time.sleep(15)
-    print(base64.b64decode(result["return"]["out-data"]))
 
-    with open("requirements.txt") as file:
-        for package in file.readlines():
-            try:
-                print(package)
-                result = runCmd(
-                    dom,
-                    "powershell.exe",
-                    ["choco", "install", package.rstrip(), "-y"],
-                )
-                print(result)
-                print(base64.b64decode(result["return"]["out-data"]))
-            except:
-                pass
+def storeObject(dest, digest):
+    """Keep one copy per SHA-256 in downloads/objects and hard link dest to it"""
+    os.makedirs(DOWNLOAD_OBJECTS, exist_ok=True)
+    obj = os.path.join(DOWNLOAD_OBJECTS, digest)
+    if os.path.exists(obj) and os.path.getsize(obj) == os.path.getsize(dest):
+        if not os.path.samefile(obj, dest):
+            os.remove(dest)
+            os.link(obj, dest)
+            print("%s has the same content as an earlier download, linked" % dest)
+    else:
+        # a truncated link damages the object too, so replace it with the fresh copy
+        if os.path.exists(obj):
+            os.remove(obj)
+        os.link(dest, obj)
 
-    dom.shutdown()
-    print("Shutting down...")
-    while dom.isActive():
-        time.sleep(5)
-    #snapshot(iname,"install","Software installed.")
-    
-    dbname = iqcow2 + ".db"
-    print(connectNBD(d, iqcow2).decode("utf-8"))
-    print(runFdisk(d).decode("utf-8"))
-    print(createSQLite(d, dbname).decode("utf-8"))
-    print(disconnectNBD(d).decode("utf-8"))
-    return iqcow2
 
+def recordDownload(name, url, dest, digest, headers):
+    """Deduplicate dest and record its url, validators, size and SHA-256 in the manifest"""
+    storeObject(dest, digest)
+    with lockedState(DOWNLOAD_MANIFEST) as manifest:
+        manifest[name] = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "size": os.path.getsize(dest),
+            "sha256": digest,
+            "fetched": time.time(),
+        }
 
-def launchSubInstance(name, conn):
-    """Launch an instance built from the customized image"""
-    iname = findInstanceName(name, conn)
-    print(iname)
-    bf1 = name + ".qcow2"
-    iqcow2 = createBaseInstanceQCOW2(bf1, iname)
-    print(iqcow2)
-    bf2 = getBackingFile(bf1)
-    dxl = defineXML(iname, [bf1, bf2], iqcow2)
-    #snapshot(dxl,"initial","Initial Snapshot")
-    dom = bootVM(dxl, conn)
 
+def cachedDownload(url, name, segments=DOWNLOAD_SEGMENTS, sha256=None):
+    """
+    1. If downloads/name is complete according to the manifest, revalidate it
+       with a conditional HEAD (If-None-Match / If-Modified-Since) and stop on 304
+       or an unchanged validator.
+    2. Otherwise (missing, truncated or changed upstream) download it again.
+    3. Deduplicate it against downloads/objects and record it in the manifest.
+       A file from before the manifest is adopted if its size matches.
+       Returns the local path."""
+    dest = os.path.join(DOWNLOAD_DIR, name)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with lockedState(DOWNLOAD_MANIFEST) as manifest:
+        entry = manifest.get(name)
+    session = httpSession(segments)
+    if cacheValid(entry, dest):
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            r = session.head(
+                url, headers=headers, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+            )
+        except requests.exceptions.ConnectionError:
+            print("%s cannot be revalidated (offline), using the cached copy." % dest)
+            return dest
+        if r.status_code == 304 or (
+            r.ok
+            and r.headers.get("ETag", entry.get("etag")) == entry.get("etag")
+            and r.headers.get("Last-Modified", entry.get("last_modified"))
+            == entry.get("last_modified")
+            and int(r.headers.get("Content-Length", entry["size"])) == entry["size"]
+        ):
+            print("%s is up to date." % dest)
+            return dest
+        print("%s changed upstream, downloading again." % dest)
+    elif entry is not None:
+        print("%s is missing or incomplete, downloading again." % dest)
+    elif os.path.exists(dest):
+        # downloaded before the manifest existed: adopt it if the size matches
+        r = session.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+        if r.ok and int(r.headers.get("Content-Length", -1)) == os.path.getsize(dest):
+            digest = sha256File(dest)
+            if sha256 is None or digest == sha256.lower():
+                recordDownload(name, url, dest, digest, r.headers)
+                print("%s added to the manifest." % dest)
+                return dest
+        print("%s is incomplete, downloading again." % dest)
 
-def downloadUrl(url, dest):
-    size = int(requests.head(url).headers["Content-Length"])
+    print("Downloading: " + dest + " from " + url + "...")
+    digest = downloadUrl(url, dest, segments, sha256)
+    r = session.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+    recordDownload(name, url, dest, digest, r.headers)
+    print("Download complete.")
+    return dest
 
-    read = 0
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(dest, "wb") as f:
-            with tqdm(
-                desc=dest,
-                total=size,
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-            ) as bar:
-                for chunk in r.iter_content(chunk_size=8192):
-                    bar.update(len(chunk))
-                    f.write(chunk)
-
-    # cl = ["/usr/bin/wget", "-N", winurl, "-P", "downloads"]
-    # process = subprocess.run(cl, capture_output=True, check=True)
-    # return process.stdout
-
-
-def downloadWinVm(winurl):
-    req_headers = requests.head(winurl)
+
+def versionKey(name):
+    """Sort key comparing the numbers in a file name numerically"""
+    return [int(p) if p.isdigit() else p for p in re.split(r"(\d+)", name)]
+
+
+def latestDownload(prefix):
+    """Return the path of the highest versioned complete download whose name starts with prefix"""
+    if not os.path.exists(DOWNLOAD_MANIFEST):
+        return None
+    with lockedState(DOWNLOAD_MANIFEST) as manifest:
+        names = [
+            n
+            for n, e in manifest.items()
+            if n.startswith(prefix) and cacheValid(e, os.path.join(DOWNLOAD_DIR, n))
+        ]
+    if not names:
+        return None
+    return os.path.join(DOWNLOAD_DIR, max(names, key=versionKey))
+
+
+def downloadWinVm(winurl, segments=DOWNLOAD_SEGMENTS, sha256=None):
+    req_headers = httpSession().head(winurl)
     winzip = req_headers.headers["Location"]
     winzipu = urlparse(winzip)
-    dest = os.path.join("downloads", os.path.basename(winzipu.path))
-    print("Downloading: " + dest + " from " + req_headers.headers["Location"] + "...")
-    if not os.path.exists(dest):
-        downloadUrl(req_headers.headers["Location"], dest)
-        print("Download complete.")
-    else:
-        print("File already downloaded.")
+    return cachedDownload(winzip, os.path.basename(winzipu.path), segments, sha256)
 
 
-def downloadVirtio(virtiourl):
-    req_headers = requests.head(virtiourl)
+def downloadVirtio(virtiourl, segments=DOWNLOAD_SEGMENTS):
+    session = httpSession()
+    req_headers = session.head(virtiourl)
     virtiozip = req_headers.headers["Location"]
-    req = requests.get(virtiourl)
+    req = session.get(virtiourl)
     soup = BeautifulSoup(req.content, features="lxml")
     for a in soup.findAll("a"):
         if a["href"].endswith(".iso") and a["href"].startswith("virtio-win-"):
-            dest = os.path.join("downloads", a["href"])
-            print("Downloading: " + dest + " from " + virtiozip + a["href"] + "...")
-            if not os.path.exists(dest):
-                downloadUrl(virtiozip + a["href"], dest)
-            else:
-                print("File already downloaded.")
+            cachedDownload(virtiozip + a["href"], a["href"], segments)
 
 
-def CreateWinTemplateVM(tag, winevalzip, tmpdir, d, conn):
+def CreateWinTemplateVM(
+    tag,
+    winevalzip,
+    tmpdir,
+    d,
+    conn,
+    stream=False,
+    profile="default",
+    tskscan=False,
+    regspec=None,
+):
     inputfile = os.path.join("downloads", os.path.basename(winevalzip))
-    f = createStorage(inputfile, tag, "workdir")
-    createCustomizedImage(f, tag, tmpdir, d, conn)
+    basekey = layerKey(None, "base", sourceInputs(inputfile))
+    with lockedState(LAYER_INDEX) as index:
+        base = index.get(basekey, {}).get("path")
+    if base is not None and os.path.exists(base):
+        print("base         %s cached" % basekey)
+        f = base
+    else:
+        f = createStorage(inputfile, tag, "workdir", stream, profile)
+        with lockedState(LAYER_INDEX) as index:
+            index[basekey] = {
+                "step": "base",
+                "parent": None,
+                "path": os.path.abspath(f),
+                "built": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+    createCustomizedImage(f, tag, tmpdir, d, conn, tskscan, regspec, basekey)
 
 
 def printDomainInfo(d):
@@ -696,32 +3771,292 @@ def printDomainInfo(d):
     print("The cpu time is " + str(cput))
 
 
-def dumpMemory(d, dname, fullpath):
-    cfname = os.path.join(fullpath, "core.dmp")
-    mfname = os.path.join(fullpath, "memory.dmp")
+# (libvirt format, extension, written strictly front to back); only the core dump
+# is a sequential migration stream, the memory-only dumps seek back to fill in
+# headers and kdump pages
+DUMP_FORMATS = {
+    "core": (None, ".core.dmp", True),
+    "raw": ("VIR_DOMAIN_CORE_DUMP_FORMAT_RAW", ".memory.dmp", False),
+    "kdump-zlib": ("VIR_DOMAIN_CORE_DUMP_FORMAT_KDUMP_ZLIB", ".kdump", False),
+    "kdump-lzo": ("VIR_DOMAIN_CORE_DUMP_FORMAT_KDUMP_LZO", ".kdump", False),
+    "kdump-snappy": ("VIR_DOMAIN_CORE_DUMP_FORMAT_KDUMP_SNAPPY", ".kdump", False),
+}
+
+
+def hashGrowingFile(path, done):
+    """
+    1. Hash path while another thread is still writing it sequentially.
+    2. Once done is set, hash whatever is left.
+    3. Return (sha256 hex digest, bytes hashed)."""
+    h = hashlib.sha256()
+    buf = bytearray(COPY_BLOCKSIZE)
+    mv = memoryview(buf)
+    total = 0
+    while not os.path.exists(path):
+        if done.is_set():
+            return None, 0
+        time.sleep(0.1)
+    with open(path, "rb") as f:
+        while True:
+            finished = done.is_set()
+            n = f.readinto(buf)
+            if n:
+                h.update(mv[:n])
+                total += n
+            elif finished:
+                break
+            else:
+                time.sleep(0.1)
+    return h.hexdigest(), total
+
+
+def dumpProgress(d, bar, done):
+    """Drive the progress bar from the domain job statistics until done is set"""
+    last = 0
+    while not done.wait(0.5):
+        try:
+            stats = d.jobStats()
+        except libvirt.libvirtError:
+            continue
+        total = stats.get("memory_total") or stats.get("data_total")
+        processed = stats.get("memory_processed") or stats.get("data_processed")
+        if total and processed is not None:
+            bar.total = total
+            bar.update(processed - last)
+            last = processed
+
+
+def acquireMemory(d, path, fmt="raw", live=False):
+    """
+    1. Take one dump of d in fmt: "core" is the libvirt core dump, the others are
+       memory-only raw or compressed kdump dumps.
+    2. Show job progress while libvirt writes it; a sequential dump is hashed in a
+       second thread as it grows, any other one once it is finished.
+    3. Write the SHA-256 next to the dump, print the timing and return the digest."""
+    flags = libvirt.VIR_DUMP_LIVE if live else 0
+    constant, ext, sequential = DUMP_FORMATS[fmt]
+    if os.path.exists(path):
+        os.remove(path)
+    done = threading.Event()
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        hashed = pool.submit(hashGrowingFile, path, done) if sequential else None
+        with tqdm(
+            desc=os.path.basename(path),
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+        ) as bar:
+            progress = threading.Thread(target=dumpProgress, args=(d, bar, done))
+            progress.start()
+            try:
+                if constant is None:
+                    d.coreDump(path, flags)
+                else:
+                    d.coreDumpWithFormat(
+                        path,
+                        getattr(libvirt, constant),
+                        flags | libvirt.VIR_DUMP_MEMORY_ONLY,
+                    )
+            finally:
+                done.set()
+                progress.join()
+        if hashed is not None:
+            digest, nbytes = hashed.result()
+        else:
+            digest, nbytes = sha256File(path), os.path.getsize(path)
+    printRate("dump " + os.path.basename(path), nbytes, time.time() - start)
+    with open(path + ".sha256", "w") as f:
+        f.write(digest + "  " + os.path.basename(path) + "\n")
+    print("sha256: " + digest)
+    return digest
+
+
+@timed("dumpMemory")
+def dumpMemory(d, dname, fullpath, fmt="both", live=False):
+    """Dump the memory of d into fullpath; "both" takes the core and the raw memory dump"""
     print("dumping...")
-    d.coreDump(cfname)
-    d.coreDumpWithFormat(
-        mfname, libvirt.VIR_DOMAIN_CORE_DUMP_FORMAT_RAW, libvirt.VIR_DUMP_MEMORY_ONLY
-    )
+    if fmt == "both":
+        acquireMemory(d, os.path.join(fullpath, "core.dmp"), "core", live)
+        acquireMemory(d, os.path.join(fullpath, "memory.dmp"), "raw", live)
+    else:
+        name = dname + "-" + time.strftime("%Y%m%d-%H%M%S") + DUMP_FORMATS[fmt][1]
+        acquireMemory(d, os.path.join(fullpath, name), fmt, live)
     print("done.")
     print(d.isActive())
 
 
-def screenShot(d, f, conn):
+def grabFrame(d, conn):
+    """Take one screenshot of d and return (mime type, image bytes)"""
     stream = conn.newStream()
     imageType = d.screenshot(stream, 0)
-    print(imageType)
-    fileHandler = open(f, "wb")
+    chunks = []
     streamBytes = stream.recv(262120)
     while streamBytes != b"":
-        fileHandler.write(streamBytes)
+        chunks.append(streamBytes)
         streamBytes = stream.recv(262120)
-    fileHandler.close()
-    print("Screenshot saved as type: " + imageType)
     stream.finish()
+    return imageType, b"".join(chunks)
+
+
+def screenShot(d, f, conn):
+    imageType, data = grabFrame(d, conn)
+    print(imageType)
+    with open(f, "wb") as fileHandler:
+        fileHandler.write(data)
+    print("Screenshot saved as type: " + imageType)
+
+
+def ppmToPNG(data):
+    """
+    1. Parse the binary PPM (P6) header the QEMU screendump produces.
+    2. Prefix every row with PNG filter type 0 and deflate the rows.
+    3. Return the PNG file bytes."""
+    tokens = []
+    pos = 2
+    while len(tokens) < 3:
+        while data[pos : pos + 1].isspace():
+            pos += 1
+        if data[pos : pos + 1] == b"#":
+            pos = data.index(b"\n", pos) + 1
+            continue
+        end = pos
+        while not data[end : end + 1].isspace():
+            end += 1
+        tokens.append(int(data[pos:end]))
+        pos = end
+    width, height, maxval = tokens
+    pos += 1
+    stride = width * 3
+    pixels = memoryview(data)[pos : pos + stride * height]
+    raw = b"".join(
+        b"\x00" + pixels[y * stride : (y + 1) * stride] for y in range(height)
+    )
+
+    def chunk(tag, body):
+        return (
+            struct.pack(">I", len(body))
+            + tag
+            + body
+            + struct.pack(">I", zlib.crc32(tag + body))
+        )
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def encodeFrame(imageType, data, path):
+    """Write a frame as PNG (or as is if it is not a PPM) and return the file name"""
+    if imageType == "image/x-portable-pixmap" and data[:2] == b"P6":
+        path += ".png"
+        data = ppmToPNG(data)
+    else:
+        path += ".img"
+    with open(path, "wb") as f:
+        f.write(data)
+    return os.path.basename(path)
+
 
-def runPS1(d,ps1,type="-Command"):
+def recordScreen(d, conn, outdir, pool, interval, duration):
+    """
+    1. Grab a frame of d every interval seconds for duration seconds.
+    2. Drop frames identical to the previous one.
+    3. Hand the rest to the encoder pool and write a timestamped entry per
+       frame to index.jsonl.
+    4. Return (frames kept, frames dropped)."""
+    ddir = os.path.join(outdir, d.name())
+    os.makedirs(ddir, exist_ok=True)
+    last = None
+    kept = dropped = 0
+    pending = []
+    end = time.monotonic() + duration
+    with open(os.path.join(ddir, "index.jsonl"), "a") as index:
+        while time.monotonic() < end:
+            tick = time.monotonic()
+            stamp = time.time()
+            imageType, data = grabFrame(d, conn)
+            digest = hashlib.sha1(data).hexdigest()
+            if digest == last:
+                dropped += 1
+            else:
+                last = digest
+                kept += 1
+                name = time.strftime("%Y%m%d-%H%M%S", time.localtime(stamp)) + (
+                    "-%03d" % (stamp % 1 * 1000)
+                )
+                pending.append(
+                    (
+                        stamp,
+                        digest,
+                        pool.submit(
+                            encodeFrame, imageType, data, os.path.join(ddir, name)
+                        ),
+                    )
+                )
+            for p in [p for p in pending if p[2].done()]:
+                pending.remove(p)
+                index.write(
+                    json.dumps({"time": p[0], "file": p[2].result(), "sha1": p[1]})
+                    + "\n"
+                )
+            time.sleep(max(0, interval - (time.monotonic() - tick)))
+        for p in pending:
+            index.write(
+                json.dumps({"time": p[0], "file": p[2].result(), "sha1": p[1]}) + "\n"
+            )
+    print("%s: %d frames kept, %d duplicates dropped" % (d.name(), kept, dropped))
+    return kept, dropped
+
+
+def recordScreens(conn, names, outdir, interval=1.0, duration=60, jobs=4):
+    """Record several domains at the same time, sharing one PNG encoder pool"""
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        with ThreadPoolExecutor(max_workers=len(names)) as recorders:
+            futures = [
+                recorders.submit(
+                    recordScreen,
+                    conn.lookupByName(n),
+                    conn,
+                    outdir,
+                    pool,
+                    interval,
+                    duration,
+                )
+                for n in names
+            ]
+            return [f.result() for f in futures]
+
+def diskBench(d, timeout=600):
+    """
+    1. Run winsat disk on the system drive through the agent.
+    2. Parse the MB/s and latency results.
+    3. Print them and return them as a dict."""
+    result = runCmd(d, "winsat.exe", ["disk", "-drive", "c"], timeout)
+    if result is None or "out-data" not in result["return"]:
+        print("winsat failed")
+        return None
+    out = base64.b64decode(result["return"]["out-data"]).decode("utf-8", "replace")
+    results = {}
+    for l in out.splitlines():
+        m = re.match(r"> (Disk .*?)\s{2,}([\d.]+) (MB/s|ms)", l)
+        if m:
+            results[m.group(1).strip()] = (float(m.group(2)), m.group(3))
+            print("%-50s %10s %s" % (m.group(1).strip(), m.group(2), m.group(3)))
+    return results
+
+
+def writeOutput(name, data):
+    """Write streamed guest output to our own stdout/stderr as it arrives"""
+    stream = sys.stderr if name == "err" else sys.stdout
+    stream.buffer.write(data)
+    stream.flush()
+
+
+def runPS1(d,ps1,type="-Command",timeout=None,onOutput=None):
     if not type in ["-Command","-File"]:
         return None
     result = runCmd(
@@ -736,8 +4071,10 @@ def runPS1(d,ps1,type="-Command"):
             type,
             ps1,
         ],
+        timeout,
+        onOutput,
     )
-    if "return" in result:
+    if result is not None and "return" in result:
         if "out-data" in result["return"]:
             return base64.b64decode(result["return"]["out-data"]).decode("utf-8")
     return result
@@ -754,7 +4091,23 @@ def main():
         "domaininfo",
         "dumpmemory",
         "screenshot",
-        "batchcopy"
+        "batchcopy",
+        "benchcopy",
+        "benchconvert",
+        "shutdown",
+        "waitready",
+        "benchxml",
+        "diskbench",
+        "changes",
+        "query",
+        "record",
+        "snapshot",
+        "snapshots",
+        "revert",
+        "deletesnapshot",
+        "reset",
+        "warmpool",
+        "chain",
     ]
     parser = argparse.ArgumentParser()
     parser.add_argument("command", choices=commands)
@@ -807,45 +4160,386 @@ def main():
     parser.add_argument(
         "--cmd", type=str, help="location for workfiles", default="whoami"
     )
+    parser.add_argument(
+        "--size",
+        type=int,
+        help="size in bytes of the synthetic tar for benchcopy",
+        default=4 * 1024 * 1024 * 1024,
+    )
+    parser.add_argument(
+        "--convertprofile",
+        type=str,
+        choices=list(CONVERT_PROFILES),
+        help="qemu-img convert profile",
+        default="default",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted copyfile/batchcopy transfer",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="batchcopy the tree as one archive and unpack it in the guest",
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        help="parallel HTTP range segments per download",
+        default=DOWNLOAD_SEGMENTS,
+    )
+    parser.add_argument(
+        "--sha256", type=str, help="expected SHA-256 of the eval download"
+    )
+    parser.add_argument(
+        "--jobs", type=int, help="concurrent transfers/operations", default=4
+    )
+    parser.add_argument(
+        "--count", type=int, help="number of instances to launch", default=1
+    )
+    parser.add_argument(
+        "--memory", type=int, help="instance memory in MiB", default=None
+    )
+    parser.add_argument("--vcpus", type=int, help="instance vCPUs", default=None)
+    parser.add_argument(
+        "--ioprofile",
+        type=str,
+        choices=list(IO_PROFILES),
+        help="disk I/O profile for new instances",
+        default="default",
+    )
+    parser.add_argument(
+        "--iterations", type=int, help="iterations for benchxml", default=1000
+    )
+    parser.add_argument(
+        "--services",
+        type=str,
+        help="comma separated services waitready waits for",
+        default="",
+    )
+    parser.add_argument(
+        "--files",
+        type=str,
+        help="comma separated guest files waitready waits for",
+        default="",
+    )
+    parser.add_argument(
+        "--db", type=str, help="index database for query", default=None
+    )
+    parser.add_argument(
+        "--otherdb", type=str, help="second index database for query diff", default=None
+    )
+    parser.add_argument(
+        "--query",
+        type=str,
+        choices=["path", "name", "hash", "list", "since", "diff"],
+        help="lookup to run against --db",
+        default="path",
+    )
+    parser.add_argument(
+        "--value", type=str, help="path, name, hash or timestamp to look up", default=""
+    )
+    parser.add_argument(
+        "--dumpformat",
+        type=str,
+        choices=["both"] + list(DUMP_FORMATS),
+        help="memory dump format (both = core.dmp and memory.dmp)",
+        default="both",
+    )
+    parser.add_argument(
+        "--live", action="store_true", help="dump without pausing the guest"
+    )
+    parser.add_argument(
+        "--interval", type=float, help="seconds between recorded frames", default=1.0
+    )
+    parser.add_argument(
+        "--duration", type=float, help="seconds to record for", default=60
+    )
+    parser.add_argument(
+        "--snapname",
+        type=str,
+        help="snapshot name for snapshot/revert/deletesnapshot/reset",
+        default=POSTINSTALL_SNAPSHOT,
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="take a post-install snapshot once a new instance is ready",
+    )
+    parser.add_argument(
+        "--metricsdir",
+        type=str,
+        help="where run metrics are written (default <tmpdir>/metrics)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="run the command under cProfile",
+    )
+    parser.add_argument(
+        "--chainaction",
+        type=str,
+        choices=["info", "commit", "rebase", "flatten"],
+        help="backing chain action",
+        default="info",
+    )
+    parser.add_argument(
+        "--image", type=str, help="qcow2 image for chain actions (default <tag>.qcow2)"
+    )
+    parser.add_argument("--base", type=str, help="backing file to commit or rebase onto")
+    parser.add_argument("--output", type=str, help="output of a flatten")
+    parser.add_argument(
+        "--compress", action="store_true", help="compress a flattened image"
+    )
+    parser.add_argument(
+        "--maxdepth",
+        type=int,
+        help="flatten the template when its chain is deeper than this (0 disables)",
+        default=CHAIN_MAX_DEPTH,
+    )
+    parser.add_argument(
+        "--poolaction",
+        type=str,
+        choices=["fill", "get", "status", "serve"],
+        help="warm pool action",
+        default="status",
+    )
+    parser.add_argument(
+        "--poolsize", type=int, help="ready clones to keep in the pool", default=2
+    )
+    parser.add_argument(
+        "--poolbudget",
+        type=int,
+        help="host memory in MiB the pool may use",
+        default=32768,
+    )
+    parser.add_argument(
+        "--poolmode",
+        type=str,
+        choices=["save", "pause"],
+        help="managed-save or pause ready clones",
+        default="save",
+    )
+    parser.add_argument(
+        "--uri",
+        type=str,
+        help="libvirt connection URI (test:///default for testing)",
+        default="qemu:///system",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="seconds to wait for a guest command before giving up",
+        default=None,
+    )
+    parser.add_argument(
+        "--regspec",
+        type=str,
+        help="JSON file of extra offline registry edits per hive",
+        default=None,
+    )
+    parser.add_argument(
+        "--tskscan",
+        action="store_true",
+        help="index the base image with tsk_loaddb to find the Windows partition",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="convert the VMDK straight from the downloaded zip",
+    )
     args = parser.parse_args()
     # print(args)
+    runMain(args)
+
+
+def runMain(args):
+    """Open an event driven connection from the event loop thread and run the
+    command on the main thread, so Ctrl-C interrupts it"""
+    startEventLoop()
+    conn = runOnLoop(openEventConnection(args.uri))
+
+    latest_file = latestDownload("virtio-win")
+    if latest_file:
+        print(latest_file)
+
+    metricsdir = args.metricsdir or os.path.join(args.tmpdir, "metrics")
+    start = time.time()
+    ok = False
+    try:
+        profileCommand(args, conn, metricsdir)
+        ok = True
+    finally:
+        conn.close()
+        eventLoop.call_soon_threadsafe(eventLoop.stop)
+        print("Metrics written to " + writeMetrics(metricsdir, args.command, start, ok))
 
-    conn = libvirt.open("qemu:///system")
 
-    list_of_files = glob.glob(
-        "downloads/virtio-win*"
-    )  # * means all if need specific format then *.csv
-    latest_file = max(list_of_files, key=os.path.getctime)
-    print(latest_file)
+def profileCommand(args, conn, metricsdir):
+    """Run the command, under cProfile with --profile (saving the stats next to the metrics)"""
+    if not args.profile:
+        return runCommand(args, conn)
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(runCommand, args, conn)
+    finally:
+        os.makedirs(metricsdir, exist_ok=True)
+        path = os.path.join(
+            metricsdir, "%s-%s.prof" % (args.command, time.strftime("%Y%m%d-%H%M%S"))
+        )
+        prof.dump_stats(path)
+        pstats.Stats(prof).sort_stats("cumulative").print_stats(25)
+        print("Profile written to " + path)
 
+
+def runCommand(args, conn):
     match args.command:
         case "downloadwineval":
-            downloadWinVm(args.winevalurl)
+            downloadWinVm(args.winevalurl, args.segments, args.sha256)
         case "downloadvirtio":
-            downloadVirtio(args.virtiourl)
+            downloadVirtio(args.virtiourl, args.segments)
         case "createwintemplate":
-            CreateWinTemplateVM(args.tag, args.winevalzip, args.tmpdir, args.dev, conn)
+            CreateWinTemplateVM(
+                args.tag,
+                args.winevalzip,
+                args.tmpdir,
+                args.dev,
+                conn,
+                args.stream,
+                args.convertprofile,
+                args.tskscan,
+                args.regspec,
+            )
         case "createwininstance":
             try:
                 conn.lookupByName(args.tag)
             except:
                 raise Exception("Template VM not found")
-            launchSubInstance(args.tag, conn)
+            memory = args.memory * 1024 if args.memory else None
+            if args.count > 1:
+                launchFleet(
+                    args.tag,
+                    conn,
+                    args.count,
+                    args.jobs,
+                    memory,
+                    args.vcpus,
+                    args.ioprofile,
+                    args.maxdepth,
+                )
+            else:
+                launchSubInstance(
+                    args.tag,
+                    conn,
+                    memory,
+                    args.vcpus,
+                    args.ioprofile,
+                    args.snapshot,
+                    args.maxdepth,
+                )
         case "copyfile":
-            copyFileGA(conn.lookupByName(args.tag), args.fromPath, args.toPath)
+            copyFileGA(
+                conn.lookupByName(args.tag), args.fromPath, args.toPath, args.resume
+            )
         case "batchcopy":
-            copyFilesGA(conn.lookupByName(args.tag),args.fromPath,args.toPath)
+            copyFilesGA(
+                conn.lookupByName(args.tag),
+                args.fromPath,
+                args.toPath,
+                args.resume,
+                args.archive,
+                args.tmpdir,
+            )
         case "runps1cmd":
-            runPS1(conn.lookupByName(args.tag),args.cmd,type="-Command")
+            runPS1(
+                conn.lookupByName(args.tag),
+                args.cmd,
+                type="-Command",
+                timeout=args.timeout,
+                onOutput=writeOutput,
+            )
         case "runps1file":
-            runPS1(conn.lookupByName(args.tag),args.cmd,type="-File")
+            runPS1(
+                conn.lookupByName(args.tag),
+                args.cmd,
+                type="-File",
+                timeout=args.timeout,
+                onOutput=writeOutput,
+            )
         case "domaininfo":
             printDomainInfo(conn.lookupByName(args.tag))
         case "dumpmemory":
-            dumpMemory(conn.lookupByName(args.tag), args.tag, args.tmpdir)
+            dumpMemory(
+                conn.lookupByName(args.tag),
+                args.tag,
+                args.tmpdir,
+                args.dumpformat,
+                args.live,
+            )
         case "screenshot":
             screenShot(conn.lookupByName(args.tag), args.toPath, conn)
-    conn.close()
+        case "benchcopy":
+            benchCopy(args.tmpdir, args.size)
+        case "benchconvert":
+            benchConvert(args.file, args.tmpdir)
+        case "waitready":
+            waitForAgent(
+                conn.lookupByName(args.tag),
+                "waitready",
+                args.timeout or READY_TIMEOUT,
+                [s for s in args.services.split(",") if s],
+                [f for f in args.files.split(",") if f],
+            )
+        case "benchxml":
+            benchXML(args.iterations)
+        case "diskbench":
+            diskBench(conn.lookupByName(args.tag), args.timeout or 600)
+        case "changes":
+            showChanges(args.dev, activeImage(conn, args.tag))
+        case "query":
+            runQuery(args.query, args.db, args.value, args.otherdb)
+        case "record":
+            recordScreens(
+                conn,
+                args.tag.split(","),
+                os.path.join(args.tmpdir, "screens"),
+                args.interval,
+                args.duration,
+                args.jobs,
+            )
+        case "snapshot":
+            snapshot(conn.lookupByName(args.tag), args.snapname, args.snapname)
+        case "snapshots":
+            listSnapshots(conn.lookupByName(args.tag))
+        case "revert":
+            revertSnapshot(conn.lookupByName(args.tag), args.snapname)
+        case "deletesnapshot":
+            deleteSnapshot(conn.lookupByName(args.tag), args.snapname)
+        case "reset":
+            resetInstance(conn.lookupByName(args.tag), args.snapname)
+        case "chain":
+            manageChain(
+                args.chainaction,
+                args.image or activeImage(conn, args.tag),
+                args.base,
+                args.output,
+                args.compress,
+            )
+        case "warmpool":
+            warmPool(
+                conn,
+                args.poolaction,
+                args.tag,
+                args.poolsize,
+                args.poolbudget,
+                args.poolmode,
+                args.jobs,
+                args.interval,
+                args.maxdepth,
+            )
+        case "shutdown":
+            shutdownDomains(conn, args.tag.split(","), args.jobs)
 
 
 if __name__ == "__main__":